@@ -13,13 +13,9 @@ AlIndex = refl.Index('Al')
 Al2O3Index = refl.Index('Al2O3')
 npts=200
 wl=np.linspace(50,200,npts)
-ndx=AlIndex.at(wl)
-ndx2=Al2O3Index.at(wl)
 thetad=75
-rfl1=[refl.matR(np.array([1,ndx2[i],ndx[i]]),np.array([0,3,0]),thetad,
-                wl[i],0)[0] for i in range(npts)]
-rfl2=[refl.matR(np.array([1,ndx[i]]),np.array([0,0]),thetad,
-                 wl[i],0)[0] for i in range(npts)]
+rfl1=refl.gridR([1,Al2O3Index,AlIndex],np.array([0,3,0]),thetad,wl)[:,0]
+rfl2=refl.gridR([1,AlIndex],np.array([0,0]),thetad,wl)[:,0]
 plt.figure()
 plt.plot(wl,rfl1,wl,rfl2)
 plt.legend(('Bare Al','3 nm Al2O3'))
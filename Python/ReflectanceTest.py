@@ -15,12 +15,8 @@ from scipy.optimize import curve_fit
 log = refl.Log() # BYU Computer
 runs = refl.Runs(log)
 
-# dark current calculation
-d7=np.mean(runs[101].diode)
-d8=np.mean(runs[98].diode)
-d9=np.mean(runs[99].diode)
-d10=np.mean(runs[100].diode)
-dark=(d7,d8,d9,d10)
+# dark current and I0 calibration
+dark = refl.Calibration(runs, (101, 98, 99, 100))
 
 # runs
 s18a = refl.Reflectance((runs[119],),runs[97], dark)
@@ -36,21 +32,21 @@ s18 = s18a.filter(2,18) + s18b.filter(18.05,80)
 s18.plot()
 
 # index objects
-AlF3Index = refl.Index("AlF3")
 AlIndex = refl.Index("Al")
 Si3N4Index = refl.Index("Si3N4")
-# interpolated values at 18 nm
-alf3ndx = AlF3Index.at(s18.wavelength)
 alndx = AlIndex.at(s18.wavelength)
-si3n4ndx = Si3N4Index.at(s18.wavelength)
+Free = refl.Free
+Layer = refl.Layer
 
-# fit function
-def f(thr, n, k, tf, ta):
-    ndx = np.array([1+0j, n+k*1j, alndx, si3n4ndx])
-    th = np.array([0, tf, ta, 0])
-    sigma = np.array([1.0,0,0]);
-    return [refl.Parratt(ndx ,th, thetad, s18.wavelength, 0, sigma)
-            for thetad in thr]
+# fit function: AlF3 film with a rough top over Al on Si3N4
+f = refl.Stack([Layer(1),
+                Layer(Free(0.95), Free(0.025), Free(8), 1.0, name='f'),
+                Layer(AlIndex, thickness=Free(26), name='a'),
+                Layer(Si3N4Index)], s18.wavelength)
+
+def print_fit(f, popt, pcov):
+    for name, p, dp in zip(f.names, popt, np.sqrt(np.diag(pcov))):
+        print(name+' = '+str(round(p,4))+"+/-"+str(round(dp,4)))
 
 alpha = 0.2
 beta = 0.097
@@ -58,18 +54,10 @@ gamma = 5e-5
 sigmap = np.array([alpha*np.exp(-beta*th) for th in s18.ang])
 sigmac = gamma
 sigmaw = np.sqrt(sigmap**2+sigmac**2)
-p0=np.array([0.95, 0.025, 8, 26])
-popt, pcov = curve_fit(f, s18.ang, s18.rfl, p0, sigmaw,
-                       absolute_sigma=False)
-print('n = '+str(round(popt[0],4))+"+/-"+
-      str(round(np.sqrt(pcov[0,0]),4)))
-print('k = '+str(round(popt[1],4))+"+/-"+
-      str(round(np.sqrt(pcov[1,1]),2)))
-print('tf = '+str(round(popt[2],2))+"+/-"+
-      str(round(np.sqrt(pcov[2,2]),2)))
-print('ta = '+str(round(popt[3],4))+"+/-"+
-      str(round(np.sqrt(pcov[3,3]),2)))
-rfit = f(s18.ang, popt[0], popt[1], popt[2], popt[3])
+popt, pcov = curve_fit(f, s18.ang, s18.rfl, f.p0, sigmaw,
+                       absolute_sigma=False, jac=f.jac)
+print_fit(f, popt, pcov)
+rfit = f(s18.ang, *popt)
 plt.figure()
 plt.semilogy(s18.ang, s18.rfl,'.',s18.ang, rfit, '-',s18.ang, sigmaw,'-r')
 plt.title('Data and Fit')
@@ -80,17 +68,10 @@ plt.legend(['data', 'fit','sigma'])
 # refit with weights proportional to the data
 sigmap = alpha*np.abs(s18.rfl)
 sigmaw = np.sqrt(sigmap**2+sigmac**2)
-popt, pcov = curve_fit(f, s18.ang, s18.rfl, p0, sigmaw,
-                       absolute_sigma=False)
-print('n = '+str(round(popt[0],4))+"+/-"+
-      str(round(np.sqrt(pcov[0,0]),4)))
-print('k = '+str(round(popt[1],4))+"+/-"+
-      str(round(np.sqrt(pcov[1,1]),2)))
-print('tf = '+str(round(popt[2],2))+"+/-"+
-      str(round(np.sqrt(pcov[2,2]),2)))
-print('ta = '+str(round(popt[3],4))+"+/-"+
-      str(round(np.sqrt(pcov[3,3]),2)))
-rfit = f(s18.ang, popt[0], popt[1], popt[2], popt[3])
+popt, pcov = curve_fit(f, s18.ang, s18.rfl, f.p0, sigmaw,
+                       absolute_sigma=False, jac=f.jac)
+print_fit(f, popt, pcov)
+rfit = f(s18.ang, *popt)
 plt.figure()
 plt.semilogy(s18.ang, s18.rfl,'.',s18.ang, rfit, '-')
 plt.title('Data and Fit')
@@ -103,28 +84,15 @@ chi2 = np.sum(((s18.rfl-rfit)/sigmaw)**2)
 print('chi**2 = '+str(round(chi2,1))+" npts = "+str(np.size(sigmaw)))
 
 # Add Al2O3 layer
-Al2O3Index = refl.Index("Al2O3")
-al2o3ndx = Al2O3Index.at(s18.wavelength)
-def f2(thr, n, k, tf, ta, to):
-    ndx = np.array([1+0j, n+k*1j, al2o3ndx, alndx, si3n4ndx])
-    th = np.array([0, tf, to, ta, 0])
-    sigma = np.array([1.0,0,0,0]);
-    return [refl.Parratt(ndx ,th, thetad, s18.wavelength, 0, sigma)
-            for thetad in thr]
-p0=np.array([0.95, 0.025, 8, 26, 1])
-popt, pcov = curve_fit(f2, s18.ang, s18.rfl, p0, sigmaw,
-                       absolute_sigma=False)
-print('n = '+str(round(popt[0],4))+"+/-"+
-      str(round(np.sqrt(pcov[0,0]),4)))
-print('k = '+str(round(popt[1],4))+"+/-"+
-      str(round(np.sqrt(pcov[1,1]),2)))
-print('tf = '+str(round(popt[2],2))+"+/-"+
-      str(round(np.sqrt(pcov[2,2]),2)))
-print('ta = '+str(round(popt[3],4))+"+/-"+
-      str(round(np.sqrt(pcov[3,3]),2)))
-print('to = '+str(round(popt[4],4))+"+/-"+
-      str(round(np.sqrt(pcov[4,4]),4)))
-rfit = f2(s18.ang, popt[0], popt[1], popt[2], popt[3], popt[4])
+f2 = refl.Stack([Layer(1),
+                 Layer(Free(0.95), Free(0.025), Free(8), 1.0, name='f'),
+                 Layer('Al2O3', thickness=Free(1), name='o'),
+                 Layer(AlIndex, thickness=Free(26), name='a'),
+                 Layer(Si3N4Index)], s18.wavelength)
+popt, pcov = curve_fit(f2, s18.ang, s18.rfl, f2.p0, sigmaw,
+                       absolute_sigma=False, jac=f2.jac)
+print_fit(f2, popt, pcov)
+rfit = f2(s18.ang, *popt)
 plt.figure()
 plt.semilogy(s18.ang, s18.rfl,'.',s18.ang, rfit, '-')
 plt.title('Data and Fit with Oxide Layer')
@@ -133,28 +101,15 @@ plt.ylabel('reflectance')
 plt.legend(['data', 'fit','sigma'])
 
 # Fit Al index of refraction
-def f3(thr, nf, kf, na, ka, tf, ta):
-    ndx = np.array([1+0j, nf+kf*1j, na+ka*1j, si3n4ndx])
-    th = np.array([0, tf, ta, 0])
-    sigma = np.array([1.0,0,0]);
-    return [refl.Parratt(ndx ,th, thetad, s18.wavelength, 0, sigma)
-            for thetad in thr]
-p0=np.array([0.95, 0.025, alndx.real, alndx.imag, 8, 26])
-popt, pcov = curve_fit(f3, s18.ang, s18.rfl, p0, sigmaw,
-                       absolute_sigma=False)
-print('nf = '+str(round(popt[0],4))+"+/-"+
-      str(round(np.sqrt(pcov[0,0]),4)))
-print('kf = '+str(round(popt[1],4))+"+/-"+
-      str(round(np.sqrt(pcov[1,1]),4)))
-print('na = '+str(round(popt[2],4))+"+/-"+
-      str(round(np.sqrt(pcov[2,2]),4)))
-print('ka = '+str(round(popt[3],4))+"+/-"+
-      str(round(np.sqrt(pcov[3,3]),4)))
-print('tf = '+str(round(popt[4],4))+"+/-"+
-      str(round(np.sqrt(pcov[4,4]),4)))
-print('ta = '+str(round(popt[5],4))+"+/-"+
-      str(round(np.sqrt(pcov[5,5]),4)))
-rfit = f3(s18.ang, popt[0], popt[1], popt[2], popt[3], popt[4], popt[5])
+f3 = refl.Stack([Layer(1),
+                 Layer(Free(0.95), Free(0.025), Free(8), 1.0, name='f'),
+                 Layer(Free(alndx.real), Free(alndx.imag), Free(26),
+                       name='a'),
+                 Layer(Si3N4Index)], s18.wavelength)
+popt, pcov = curve_fit(f3, s18.ang, s18.rfl, f3.p0, sigmaw,
+                       absolute_sigma=False, jac=f3.jac)
+print_fit(f3, popt, pcov)
+rfit = f3(s18.ang, *popt)
 plt.figure()
 plt.semilogy(s18.ang, s18.rfl,'.',s18.ang, rfit, '-')
 plt.title('Data and Fit Varyin Al Index')
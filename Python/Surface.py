@@ -7,9 +7,199 @@ Created on Wed Aug  5 10:37:00 2015
 
 import numpy as np
 import scipy.stats as stats
+import scipy.fft as fft
 import matplotlib.pyplot as plt
 
-    
+def gaussianPSD(sigma, corrlen, dim=1):
+    """Power spectral density of a surface with a Gaussian correlation
+    function C(r) = sigma**2*exp(-r**2/corrlen**2)
+
+    Parameters
+    ----------
+    sigma : number
+        rms roughness
+    corrlen : number
+        correlation length
+    dim : integer
+        1 for a line, 2 for a surface
+
+    Returns
+    -------
+    psd : function
+        psd(k) at the spatial angular frequency k (radians per unit
+        length), normalized so that the integral of psd over all k
+        divided by (2*pi)**dim is sigma**2
+    """
+    a = sigma**2*(np.sqrt(np.pi)*corrlen)**dim
+    return lambda k: a*np.exp(-(k*corrlen)**2/4)
+
+def exponentialPSD(sigma, corrlen, dim=1):
+    """Power spectral density of a surface with an exponential
+    correlation function C(r) = sigma**2*exp(-r/corrlen)
+
+    Parameters and Returns as for gaussianPSD
+    """
+    if dim==1:
+        return lambda k: 2*sigma**2*corrlen/(1+(k*corrlen)**2)
+    return lambda k: 2*np.pi*sigma**2*corrlen**2/(1+(k*corrlen)**2)**1.5
+
+def synthesize(shape, spacing, psd, seed=None, dtype=np.float64,
+               filename=None, block=1024):
+    """Random surface heights with a given power spectral density
+
+    Random complex amplitudes are drawn directly in frequency space,
+    scaled by the square root of the PSD and transformed back with
+    real FFTs. The spectrum is built and transformed a block of rows
+    or columns at a time, the last transform straight into the output,
+    which may be a memory mapped file, so the only other full-size
+    array is the half spectrum. The surface is periodic with the size
+    of the grid and has zero mean.
+
+    Parameters
+    ----------
+    shape : integer or tuple of integers
+        number of points of a line, or (ny, nx) of a surface
+    spacing : number
+        distance between points
+    psd : function
+        psd(k) of the spatial angular frequency, as from gaussianPSD,
+        for a surface of the same dimension as shape
+    seed : integer
+        seed for the random amplitudes
+    dtype : np.dtype
+        np.float64, or np.float32 for half the memory and time
+    filename : string
+        if given, the heights are written to this file as a np.memmap
+    block : integer
+        number of rows transformed at once
+
+    Returns
+    -------
+    h : np.array or np.memmap
+        heights with the given shape
+
+    Example
+    -------
+    >>> h = synthesize((8192, 8192), 1.0, gaussianPSD(0.5, 20, 2),
+    ...                dtype=np.float32, filename='surface.dat')
+    >>> rms(h)
+    0.5
+    """
+    shape = tuple(int(n) for n in np.atleast_1d(shape))
+    dtype = np.dtype(dtype)
+    ctype = np.result_type(dtype, np.complex64)
+    rng = np.random.default_rng(seed)
+    half = shape[:-1]+(shape[-1]//2+1,)
+    freqs = [fft.fftfreq(n, spacing)*2*np.pi for n in shape[:-1]]
+    kx2 = (fft.rfftfreq(shape[-1], spacing)*2*np.pi)**2
+    # E|amplitude|**2 = N psd/dV, so the variance of the heights is the
+    # integral of psd/(2 pi)**dim
+    scale = np.sqrt(np.prod(shape)/2/spacing**len(shape))
+    # irfft keeps only the real part of the kx=0 (and even Nyquist)
+    # column, which would halve its power
+    real = [0, -1] if shape[-1]%2==0 else [0]
+    spec = np.empty(half, dtype=ctype)
+    srows = spec.reshape((-1, half[-1]))
+    for i in range(0, srows.shape[0], block):
+        j = min(i+block, srows.shape[0])
+        ky2 = np.zeros(j-i)
+        if len(shape)>1:
+            for f, idx in zip(freqs, np.unravel_index(np.arange(i, j),
+                                                      half[:-1])):
+                ky2 += f[idx]**2
+        amp = scale*np.sqrt(psd(np.sqrt(ky2[:,np.newaxis]+kx2)))
+        amp[:,real] *= np.sqrt(2)
+        amp = amp.astype(dtype)
+        # drawn a row at a time in double precision, so the heights do
+        # not depend on block or dtype
+        z = rng.standard_normal((j-i, half[-1], 2))
+        srows[i:j].real = z[...,0]*amp
+        srows[i:j].imag = z[...,1]*amp
+    spec.flat[0] = 0
+    if len(shape)>1:
+        axes = tuple(range(len(shape)-1))
+        for i in range(0, half[-1], block):
+            spec[...,i:i+block] = fft.ifftn(spec[...,i:i+block], axes=axes)
+    if filename is None:
+        h = np.empty(shape, dtype=dtype)
+    else:
+        h = np.memmap(filename, dtype=dtype, mode='w+', shape=shape)
+    if len(shape)==1:
+        h[:] = fft.irfft(spec, shape[-1])
+    else:
+        rows = h.reshape((-1, shape[-1]))
+        spec = spec.reshape((-1, half[-1]))
+        for i in range(0, rows.shape[0], block):
+            rows[i:i+block] = fft.irfft(spec[i:i+block], shape[-1], axis=-1)
+    if filename is not None:
+        h.flush()
+    return h
+
+def rms(h, block=1024):
+    """rms height about the mean, a block of rows at a time so memory
+    mapped surfaces are not read in whole"""
+    rows = np.reshape(h, (-1, np.shape(h)[-1]))
+    total = 0.0
+    for i in range(0, rows.shape[0], block):
+        total += np.sum(rows[i:i+block], dtype=np.float64)
+    mean = total/np.size(h)
+    total = 0.0
+    for i in range(0, rows.shape[0], block):
+        total += np.sum((rows[i:i+block]-mean)**2, dtype=np.float64)
+    return np.sqrt(total/np.size(h))
+
+def psd(h, spacing, block=1024):
+    """Power spectral density along the last axis, averaged over rows
+
+    This is the line PSD an AFM scan gives, normalized as for
+    gaussianPSD with dim=1, so its integral over k (both signs) divided
+    by 2 pi is the mean square height. The surface is taken as
+    periodic.
+
+    Parameters
+    ----------
+    h : np.array
+        heights of a line, or of a surface with rows along the last axis
+    spacing : number
+        distance between points
+    block : integer
+        number of rows transformed at once
+
+    Returns
+    -------
+    (k, p) : np.array
+        angular frequencies from 0 to the Nyquist frequency and the PSD
+        at each of them
+    """
+    n = np.shape(h)[-1]
+    rows = np.reshape(h, (-1, n))
+    p = np.zeros(n//2+1)
+    for i in range(0, rows.shape[0], block):
+        p += np.sum(np.abs(fft.rfft(rows[i:i+block], axis=-1))**2, axis=0)
+    k = fft.rfftfreq(n, spacing)*2*np.pi
+    return (k, p*spacing/n/rows.shape[0])
+
+def autocorrelation(h, spacing, block=1024):
+    """Autocorrelation along the last axis, averaged over rows
+
+    Found from the PSD (Wiener-Khinchin), so it is circular like the
+    surfaces from synthesize.
+
+    Parameters
+    ----------
+    h, spacing, block : as for psd
+
+    Returns
+    -------
+    (r, c) : np.array
+        lags from 0 to half the length and the autocorrelation at each,
+        with c[0] the mean square height
+    """
+    n = np.shape(h)[-1]
+    k, p = psd(h, spacing, block)
+    c = fft.irfft(p, n)/spacing
+    return (np.arange(n//2+1)*spacing, c[:n//2+1])
+
 class Surface:
     """class for representing a 1d surface
     
@@ -33,7 +223,7 @@ class Surface:
     0.015
     """
     
-    def __init__(self, sigma, length, npts):
+    def __init__(self, sigma, length, npts, corrlen=0, seed=None):
         """Constructor to initialize surface
         
         Parameters
@@ -44,6 +234,11 @@ class Surface:
             length of surface
         npts : integer
             number of points in surface
+        corrlen : number
+            Gaussian correlation length. If zero, the heights are
+            uncorrelated.
+        seed : integer
+            seed for correlated heights
         
         Returns
         -------
@@ -53,9 +248,15 @@ class Surface:
         -------
         >>> surf = Surface(0.1,5.0,100)
             creates surface
+        >>> surf = Surface(0.1,500.0,4096,corrlen=20)
+            creates a correlated surface
         """
         self.xp=np.linspace(0,length,npts)
-        self.yp=stats.norm.rvs(0,sigma,npts)
+        if corrlen==0:
+            self.yp=stats.norm.rvs(0,sigma,npts)
+        else:
+            self.yp=synthesize(npts,length/(npts-1),
+                               gaussianPSD(sigma,corrlen),seed)
     
     def plot(self):
         plt.plot(self.xp,self.yp)
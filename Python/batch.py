@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 14:05:12 2026
+
+Fit every spectrum of a beamtime from a job file.
+
+    python batch.py jobs.json -o results.txt -w 8
+
+The job file is JSON. The beamtime is given by the path and prefix of
+its log (or by an archive written with refl.writeArchive), the dark
+runs and normalization are given for the whole file and may be
+overridden by a job, since the dark current drifts over a beamtime,
+and the stack models are named so several spectra can use the same
+one:
+
+    {"path": "X:/ALSData/2018/Feb2018", "prefix": "Feb2018",
+     "dark": [101, 98, 99, 100], "norm": "none",
+     "models": {"alf3": [{"n": 1},
+                         {"n": [0.95, 0.8, 1.1], "k": [0.025, 0, 0.2],
+                          "thickness": [8, 0, 30], "sigma": 1.0,
+                          "name": "f"},
+                         {"n": "Al", "thickness": [26, 0, 60],
+                          "name": "a"},
+                         {"n": "Si3N4"}]},
+     "jobs": [{"name": "s18", "runs": [[119], [120, 121]], "i0": 97,
+               "windows": [[2, 18], [18.05, 80]], "model": "alf3"},
+              {"name": "s52", "runs": [[153]], "i0": 150,
+               "dark": [151, 148, 149, 150], "model": "alf3"}]}
+
+Each job lists groups of reflectance runs and, if given, one angle
+window per group. Every group is made into a Reflectance, cut to its
+window and the groups are added. A number in a layer is fixed, a list
+[value, lower, upper] (or [value]) is a free parameter and a string is
+a material for refl.Index. The data are
+weighted with sigma = sqrt((alpha*R)**2+gamma**2), where alpha and gamma
+may be set for the whole file or for a job. The polarization profile
+(refl.Polarization) is the ALS one unless "polarization" names another
+for the file or a job; tables of photon energy in eV and degree of
+polarization can be given by name in "polarizations".
+
+The spectra are read here, with one refl.Calibration for each distinct
+set of dark runs and normalization, and fitted in a pool of worker
+processes. A job that fails, while reading its runs or in its fit, is
+reported in the results table and the others go on.
+"""
+
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy.optimize import curve_fit
+import refl
+
+def _param(p):
+    """fixed number, Free parameter or material name from the job file"""
+    if isinstance(p, list):
+        return refl.Free(*p)
+    return p
+
+def layers(model):
+    """
+    Layers of a stack model from the job file
+
+    Parameters
+    ----------
+    model : list of dict
+        one dict per layer with the keyword arguments of refl.Layer
+
+    Returns
+    -------
+    layers : list of refl.Layer
+    """
+    return [refl.Layer(**{key: _param(p) for key, p in layer.items()})
+            for layer in model]
+
+def readJobs(filename):
+    """the job file as a dict"""
+    with open(filename) as f:
+        return json.load(f)
+
+def _reflectance(runs, cal, job):
+    """the spectrum of a job, with its groups of runs joined"""
+    groups = job['runs']
+    windows = job.get('windows', [[0, 90]]*len(groups))
+    if len(windows)!=len(groups):
+        raise ValueError(str(len(groups))+' groups of runs but '+
+                         str(len(windows))+' windows')
+    spectrum = refl.Reflectance()
+    for group, (thmin, thmax) in zip(groups, windows):
+        r = refl.Reflectance(tuple(runs[i] for i in group), runs[job['i0']],
+                             cal, job.get('polarization')).filter(thmin,
+                                                                  thmax)
+        spectrum = r if spectrum.ang.size==0 else spectrum+r
+    return spectrum
+
+def fitJob(job, model, ang, rfl, wavelength, frs, alpha=0.2, gamma=5e-5):
+    """
+    Fit one spectrum with a stack model
+
+    Parameters
+    ----------
+    job : dict
+        the job, for its name
+    model : list of dict
+        the layers of the stack as in the job file
+    ang, rfl : np.array
+        the spectrum
+    wavelength, frs : float
+        its wavelength and fraction of s polarization
+    alpha, gamma : float
+        proportional and constant parts of the uncertainty
+
+    Returns
+    -------
+    row : dict
+        name, wavelength, npts, chi2, status, nfev (model evaluations of
+        the fit) and the parameters with their uncertainties
+        (name+'_err')
+    """
+    f = refl.Stack(layers(model), wavelength, frs)
+    sigma = np.sqrt((alpha*rfl)**2+gamma**2)
+    popt, pcov, info = curve_fit(f, ang, rfl, f.p0, sigma,
+                                 absolute_sigma=False, bounds=f.bounds,
+                                 jac=f.jac, full_output=True)[:3]
+    row = {'name': job['name'], 'wavelength': wavelength, 'npts': ang.size,
+           'chi2': np.sum(((f(ang, *popt)-rfl)/sigma)**2), 'status': 'ok',
+           'nfev': info['nfev']}
+    for name, p, dp in zip(f.names, popt, np.sqrt(np.diag(pcov))):
+        row[name] = p
+        row[name+'_err'] = dp
+    return row
+
+def _timedfit(args):
+    """fitJob in a worker process, with its time and any error caught"""
+    start = time.perf_counter()
+    try:
+        row = fitJob(*args)
+    except Exception as e:
+        row = {'name': args[0]['name'], 'wavelength': args[4],
+               'npts': args[2].size,
+               'status': type(e).__name__+': '+str(e)}
+    row['seconds'] = time.perf_counter()-start
+    return row
+
+def runJobs(jobs, workers=None):
+    """
+    Read and fit all spectra of a job file
+
+    Parameters
+    ----------
+    jobs : dict
+        the job file, as read by readJobs
+    workers : int
+        number of worker processes; the fits run here if it is 1
+
+    Returns
+    -------
+    rows : list of dict
+        one row per job in the order of the job file, as from fitJob,
+        with the time of the job in 'seconds'
+    """
+    if 'archive' in jobs:
+        runs = refl.openArchive(jobs['archive'])
+    else:
+        runs = refl.Runs(refl.Log(jobs['path'], jobs['prefix']))
+    cals = {}
+    for name, table in jobs.get('polarizations', {}).items():
+        refl.addPolarization(refl.Polarization(table, name))
+    rows = [None]*len(jobs['jobs'])
+    tasks = []
+    for i, job in enumerate(jobs['jobs']):
+        if 'polarization' in jobs:
+            job = dict(job, polarization=job.get('polarization',
+                                                 jobs['polarization']))
+        start = time.perf_counter()
+        try:
+            dark = job.get('dark', jobs.get('dark'))
+            if dark is None:
+                raise ValueError('no dark runs given')
+            key = (tuple(dark), job.get('norm', jobs.get('norm', 'none')))
+            if key not in cals:
+                cals[key] = refl.Calibration(runs, *key)
+            s = _reflectance(runs, cals[key], job)
+            model = jobs['models'][job['model']]
+        except Exception as e:
+            rows[i] = {'name': job['name'], 'status':
+                       type(e).__name__+': '+str(e),
+                       'seconds': time.perf_counter()-start}
+            continue
+        args = (job, model, s.ang, s.rfl, s.wavelength, s.frs,
+                job.get('alpha', jobs.get('alpha', 0.2)),
+                job.get('gamma', jobs.get('gamma', 5e-5)))
+        tasks.append((i, args, time.perf_counter()-start))
+    if workers==1:
+        done = [_timedfit(args) for i, args, t in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            done = list(ex.map(_timedfit, [args for i, args, t in tasks]))
+    for (i, args, t), row in zip(tasks, done):
+        row['seconds'] += t
+        rows[i] = row
+    return rows
+
+def writeResults(rows, filename):
+    """
+    Write the fit results as a tab separated table
+
+    The first columns are name, wavelength, npts, chi2, seconds and
+    status, followed by every parameter of any model and its
+    uncertainty. Parameters a job does not have are left blank.
+    """
+    first = ['name', 'wavelength', 'npts', 'chi2', 'seconds', 'status']
+    columns = list(first)
+    for row in rows:
+        columns += [c for c in row if c not in columns]
+    with open(filename, 'w') as f:
+        f.write('\t'.join(columns)+'\n')
+        for row in rows:
+            f.write('\t'.join(str(row.get(c, '')) for c in columns)+'\n')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Fit every spectrum listed in a job file')
+    parser.add_argument('jobs', help='JSON job file')
+    parser.add_argument('-o', '--output', default='results.txt',
+                        help='results table (default results.txt)')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='worker processes (default: one per CPU)')
+    args = parser.parse_args(argv)
+    start = time.perf_counter()
+    rows = runJobs(readJobs(args.jobs), args.workers)
+    wall = time.perf_counter()-start
+    writeResults(rows, args.output)
+    failed = [row for row in rows if row['status']!='ok']
+    for row in failed:
+        print(row['name']+': '+row['status'], file=sys.stderr)
+    nfev = sum(row.get('nfev', 0) for row in rows)
+    print(str(len(rows)-len(failed))+' of '+str(len(rows))+
+          ' jobs fitted in '+str(round(wall, 1))+' s ('+
+          str(round(60*len(rows)/wall, 1))+' spectra per minute, '+
+          str(round(nfev/wall, 1))+' model evaluations per second)')
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
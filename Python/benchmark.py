@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 16:40:21 2026
+
+Benchmarks of the refl hot paths.
+
+    python benchmark.py -o new.json -b baseline.json
+
+Each benchmark is timed with timeit: the number of calls per repeat is
+chosen so a repeat takes at least 0.1 s, and the minimum and median
+time per call over the repeats are kept. Results are written as JSON
+with the versions of Python, numpy and scipy. Given a baseline (an
+earlier output file) every benchmark whose median is more than
+tolerance slower is flagged as a regression, and the exit status is 1.
+
+Everything runs offline: the index tables are read from the .nk files
+bundled with refl, and the beamtime files are synthetic, written to a
+temporary directory.
+"""
+
+import os
+import sys
+import json
+import time
+import timeit
+import argparse
+import platform
+import tempfile
+import numpy as np
+import scipy
+from scipy.optimize import curve_fit
+import refl
+
+# name: function that sets up a benchmark and returns the call to time.
+# Its argument is the directory of the synthetic beamtime.
+benchmarks = {}
+
+def benchmark(fun):
+    benchmarks[fun.__name__] = fun
+    return fun
+
+def writeBeamtime(path, prefix='Bench', nruns=300, npts=1000,
+                  gains=(7, 8, 9, 10)):
+    """write a log of nruns runs, with the gains in turn, and a data file
+    of npts points for each of the first len(gains) runs, as recorded
+    at the ALS"""
+    ndata = min(len(gains), nruns)
+    gains = np.resize(gains, nruns)
+    with open(os.path.join(path, prefix+'.log'), 'w') as f:
+        f.write('log file\n')
+        f.write('\t'.join('c'+str(j) for j in range(30))+'\n')
+        for run, gain in enumerate(gains, 1):
+            row = [str(run), 'x', prefix+str(run)+'.dat', 'run '+str(run),
+                   '2/1/2018', '10:{:02d}'.format(run%60)]+['1.5']*24
+            row[8] = str(gain)
+            row[26] = '15.0'
+            f.write('\t'.join(row)+'\n')
+    for run, gain in enumerate(gains[:ndata], 1):
+        th = np.linspace(1, 80, npts)+run/10
+        data = np.array([th, 10**gain*np.exp(-th/20)+run,
+                         np.full(npts, 2.0), np.full(npts, 500.0)]).T
+        np.savetxt(os.path.join(path, prefix+str(run)+'.dat'), data,
+                   delimiter='\t', header='theta\tdiode\tm3\tbeam',
+                   comments='')
+
+def _stack(lam):
+    """index and thickness of the ReflectanceTest stack"""
+    n = np.array([1, 0.95+0.025j, refl.Index('Al').at(lam),
+                  refl.Index('Si3N4').at(lam)])
+    return (n, np.array([0, 8.0, 26, 0]), np.array([1.0, 0, 0]))
+
+@benchmark
+def parratt_point(path):
+    n, t, sigma = _stack(15)
+    return lambda: refl.Parratt(n, t, 20.0, 15, 0, sigma)
+
+@benchmark
+def parratt_array(path):
+    n, t, sigma = _stack(15)
+    thr = np.linspace(1, 80, 500)
+    return lambda: refl.Parratt(n, t, thr, 15, 0, sigma)
+
+@benchmark
+def matR_point(path):
+    n, t, sigma = _stack(15)
+    return lambda: refl.matR(n, t, 20.0, 15, sigma)
+
+@benchmark
+def matR_array(path):
+    n, t, sigma = _stack(15)
+    thr = np.linspace(1, 80, 500)
+    return lambda: refl.matR(n, t, thr, 15, sigma)
+
+@benchmark
+def nk_parse(path):
+    with open(os.path.join(refl.nkbundled, 'Al.nk')) as f:
+        text = f.read()
+    return lambda: refl._readnk(text)
+
+@benchmark
+def index_construct(path):
+    refl.nkTable('Al')
+    return lambda: refl.Index('Al')
+
+@benchmark
+def index_at_point(path):
+    al = refl.Index('Al')
+    return lambda: al.at(15.0)
+
+@benchmark
+def index_at_array(path):
+    al = refl.Index('Al')
+    lam = np.linspace(5, 50, 1000)
+    return lambda: al.at(lam)
+
+@benchmark
+def log_parse(path):
+    return lambda: refl.Log(path, 'Bench')
+
+@benchmark
+def run_parse(path):
+    log = refl.Log(path, 'Bench')
+    return lambda: refl.Run(log, 1)
+
+def _spectra(path):
+    log = refl.Log(path, 'Bench')
+    runs = [refl.Run(log, i) for i in range(1, 5)]
+    return (runs, (0, 2, 3, 4))
+
+@benchmark
+def reflectance_build(path):
+    runs, dark = _spectra(path)
+    return lambda: refl.Reflectance((runs[2], runs[3]), runs[0], dark)
+
+@benchmark
+def reflectance_merge(path):
+    runs, dark = _spectra(path)
+    a = refl.Reflectance((runs[2],), runs[0], dark)
+    b = refl.Reflectance((runs[3],), runs[0], dark)
+    return lambda: a+b
+
+@benchmark
+def reflectance_filter(path):
+    runs, dark = _spectra(path)
+    a = refl.Reflectance((runs[2], runs[3]), runs[0], dark)
+    return lambda: a.filter(10, 60)
+
+@benchmark
+def fit_stack(path):
+    lam = 15
+    Free, Layer = refl.Free, refl.Layer
+    f = refl.Stack([Layer(1),
+                    Layer(Free(0.95), Free(0.025), Free(8), 1.0, name='f'),
+                    Layer('Al', thickness=Free(26), name='a'),
+                    Layer('Si3N4')], lam)
+    thr = np.linspace(2, 80, 400)
+    rng = np.random.RandomState(0)
+    exact = f(thr, 0.93, 0.03, 9.5, 24)
+    sigma = 0.02*exact+5e-5
+    rfl = exact+sigma*rng.standard_normal(thr.size)
+    return lambda: curve_fit(f, thr, rfl, f.p0, sigma, jac=f.jac)
+
+def run(names=None, repeat: int = 5, mintime: float = 0.1):
+    """
+    Time the benchmarks
+
+    Parameters
+    ----------
+    names : list of string
+        benchmarks to run, all of them if None
+    repeat : int
+        number of repeats
+    mintime : float
+        least time of one repeat in seconds
+
+    Returns
+    -------
+    results : dict
+        'meta' with the versions and date, and 'results' with the
+        number of calls per repeat and the minimum and median seconds
+        per call of each benchmark
+    """
+    nkcache = refl.nkcache
+    refl.nkcache = refl.nkbundled # never go to the network
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as path:
+            writeBeamtime(path)
+            for name, setup in benchmarks.items():
+                if names and name not in names:
+                    continue
+                timer = timeit.Timer(setup(path))
+                number = 1
+                while timer.timeit(number)<mintime and number<10**7:
+                    number *= 10
+                times = np.array(timer.repeat(repeat, number))/number
+                results[name] = {'number': number, 'min': np.min(times),
+                                 'median': np.median(times)}
+    finally:
+        refl.nkcache = nkcache
+    meta = {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__, 'scipy': scipy.__version__,
+            'machine': platform.machine(), 'repeat': repeat}
+    return {'meta': meta, 'results': results}
+
+def compare(results, baseline, tolerance: float = 0.25):
+    """
+    Compare results with a baseline
+
+    Returns
+    -------
+    rows : list of tuple
+        (name, baseline median, new median, ratio, regressed) for every
+        benchmark in both
+    """
+    rows = []
+    for name, new in results['results'].items():
+        old = baseline['results'].get(name)
+        if old is None:
+            continue
+        ratio = new['median']/old['median']
+        rows.append((name, old['median'], new['median'], ratio,
+                     ratio>1+tolerance))
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark refl')
+    parser.add_argument('names', nargs='*',
+                        help='benchmarks to run (default all): '+
+                        ', '.join(benchmarks))
+    parser.add_argument('-o', '--output', help='write results as JSON')
+    parser.add_argument('-b', '--baseline', help='JSON results to compare')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.25,
+                        help='slowdown flagged as a regression '
+                        '(default 0.25)')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+    results = run(args.names, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.baseline is None:
+        for name, r in results['results'].items():
+            print('{:20s} {:12.3e} s'.format(name, r['median']))
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    rows = compare(results, baseline, args.tolerance)
+    for name, old, new, ratio, slow in rows:
+        print('{:20s} {:12.3e} {:12.3e} {:6.2f}{}'.format(
+            name, old, new, ratio, '  REGRESSION' if slow else ''))
+    return 1 if any(row[4] for row in rows) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,638 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 09:12:40 2026
+
+Fitting tools built around curve_fit and refl.Parratt: multi-start
+fits, Monte Carlo and bootstrap uncertainty estimates and warm-started
+fits of series of spectra, run in a pool of worker processes, and
+refits of a spectrum while it is measured.
+
+The model and data are handed to the workers when the pool starts, so
+fit functions may be closures (like the ones refl.ParrattFit returns).
+This needs the workers to be forked. Where fork is not available
+(Windows) every fit runs in the calling process.
+"""
+
+import os
+import threading
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from scipy.optimize import curve_fit
+import refl
+
+# the fit problem of a worker process, set by _setjob
+_job = None
+
+def _setjob(*job):
+    global _job
+    _job = job
+
+def _clearjob():
+    """drop the fit problem, and its data, once fits run here are done"""
+    global _job
+    _job = None
+
+def _localfit(p0):
+    """curve_fit from p0 on the job of this process"""
+    f, xdata, ydata, sigma, kwargs = _job[:5]
+    try:
+        popt, pcov = curve_fit(f, xdata, ydata, p0, sigma, **kwargs)
+    except (RuntimeError, ValueError):
+        return None
+    res = np.asarray(f(xdata, *popt))-ydata
+    if sigma is not None:
+        res = res/sigma
+    return (popt, pcov, np.sum(res**2))
+
+def _refit(i):
+    """curve_fit of data set i of the job, starting from the job's p0"""
+    f, xdata, ydata, sigma, kwargs, p0 = _job
+    try:
+        return curve_fit(f, xdata, ydata[i], p0, sigma, **kwargs)[0]
+    except (RuntimeError, ValueError):
+        return None
+
+def _bootfit(i):
+    """curve_fit of bootstrap replicate i, starting from the job's p0"""
+    f, xdata, ydata, sigma, kwargs, p0, mode, draws, model = _job
+    idx = draws[i]
+    if mode=='pairs':
+        x, y = xdata[idx], ydata[idx]
+        s = None if sigma is None else sigma[idx]
+    else:
+        res = ydata-model if sigma is None else (ydata-model)/sigma
+        x, s = xdata, sigma
+        y = model+(res[idx] if sigma is None else sigma*res[idx])
+    try:
+        return curve_fit(f, x, y, p0, s, **kwargs)[0]
+    except (RuntimeError, ValueError):
+        return None
+
+def _workers(workers):
+    """number of worker processes to use: every core for zero, and one
+    (fit here) where the workers cannot be forked"""
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return 1
+    return workers or os.cpu_count()
+
+def _pool(workers, job):
+    """pool of forked worker processes that all know the fit problem"""
+    return ProcessPoolExecutor(max_workers=workers, initializer=_setjob,
+                               initargs=job,
+                               mp_context=multiprocessing.get_context('fork'))
+
+def _map(fun, args, workers, job):
+    """fun over args in a process pool, or here if workers is 1"""
+    if workers==1:
+        _setjob(*job)
+        try:
+            return [fun(a) for a in args]
+        finally:
+            _clearjob()
+    with _pool(workers, job) as ex:
+        chunk = max(1, len(args)//(4*workers))
+        return list(ex.map(fun, args, chunksize=chunk))
+
+class Minimum:
+    """ A local minimum of chi**2 found by multistart
+    
+    Attributes
+    ----------
+    popt : np.array
+        best fit parameters
+    pcov : np.array
+        covariance of the parameters, as returned by curve_fit
+    chi2 : float
+        chi**2 at popt
+    count : int
+        number of starting points that ended at this minimum
+    """
+    def __init__(self, popt, pcov, chi2):
+        self.popt = popt
+        self.pcov = pcov
+        self.chi2 = chi2
+        self.count = 1
+    def __repr__(self):
+        return ('Minimum(popt='+str(self.popt)+', chi2='+str(self.chi2)+
+                ', count='+str(self.count)+')')
+
+def multistart(f, xdata, ydata, bounds, nstart: int = 32, sigma=None,
+               p0=None, jac=None, absolute_sigma: bool = False,
+               workers: int = 0, seed=None, tol: float = 1e-3):
+    """Fit from many starting points and return the distinct minima
+    
+    Parameters
+    ----------
+    f, xdata, ydata, sigma, absolute_sigma, jac : as in curve_fit
+    bounds : tuple of arrays
+        (lower, upper) bounds of the parameters, which must be finite.
+        Starting points are drawn uniformly between them and the fits
+        are bounded by them.
+    nstart : int
+        number of starting points
+    p0 : np.array
+        if given, used as the first starting point
+    workers : int
+        number of worker processes. Zero uses every core and one fits
+        in this process.
+    seed : int
+        seed for the random starting points
+    tol : float
+        minima whose parameters all agree within tol times the width
+        of the bounds are taken to be the same
+        
+    Returns
+    -------
+    list of Minimum, best (lowest chi**2) first. Fits that failed or
+    ended at a non-finite chi**2 are left out.
+    
+    Example
+    -------
+    >>> f, jac = refl.ParrattFit(ndx, th, wl, [('n',1), ('k',1), ('x',1)])
+    >>> minima = multistart(f, thr, refn, ([0.8, 0, 5], [1.1, 0.2, 40]),
+    ...                     64, sigma, jac=jac)
+    >>> best = minima[0].popt
+    """
+    lb, ub = (np.asarray(b, dtype=float) for b in bounds)
+    if not (np.all(np.isfinite(lb)) and np.all(np.isfinite(ub))):
+        raise ValueError('multistart needs finite bounds to draw the '
+                         'starting points from')
+    rng = np.random.RandomState(seed)
+    starts = lb+(ub-lb)*rng.random_sample((nstart, lb.size))
+    if p0 is not None:
+        starts[0] = p0
+    kwargs = {'absolute_sigma': absolute_sigma, 'bounds': (lb, ub)}
+    if jac is not None:
+        kwargs['jac'] = jac
+    job = (f, xdata, ydata, sigma, kwargs)
+    fits = _map(_localfit, list(starts), _workers(workers), job)
+    minima = []
+    scale = tol*(ub-lb)
+    fits = [fit for fit in fits if fit is not None and
+            np.isfinite(fit[2]) and np.all(np.isfinite(fit[0]))]
+    for popt, pcov, chi2 in sorted(fits, key=lambda fit: fit[2]):
+        for m in minima:
+            if np.all(np.abs(m.popt-popt) <= scale):
+                m.count += 1
+                break
+        else:
+            minima.append(Minimum(popt, pcov, chi2))
+    return minima
+
+class MonteCarlo:
+    """ Parameter spread from fits to simulated data
+    
+    Attributes
+    ----------
+    popt : np.array
+        parameters the data were simulated with
+    pcov : np.array
+        covariance estimated by the original fit, if it was given
+    params : np.array
+        (nreal, len(popt)) fitted parameters of each realization. Rows
+        of fits that failed are nan.
+    nfail : int
+        number of fits that failed
+    mean : np.array
+        mean of the fitted parameters
+    rms : np.array
+        rms deviation of the fitted parameters from their mean
+    cov : np.array
+        covariance of the fitted parameters
+    """
+    def __init__(self, popt, pcov, params):
+        self.popt = popt
+        self.pcov = pcov
+        self.params = params
+        ok = params[~np.any(np.isnan(params), axis=1)]
+        self.nfail = params.shape[0]-ok.shape[0]
+        self.mean = np.mean(ok, axis=0)
+        self.rms = np.std(ok, axis=0)
+        self.cov = np.cov(ok, rowvar=False, bias=True)
+
+def montecarlo(f, xdata, popt, sigmap: float = 0, sigmac: float = 0,
+               nreal: int = 1000, sigma=None, pcov=None, jac=None,
+               absolute_sigma: bool = False, workers: int = 0, seed=None):
+    """Monte Carlo estimate of the uncertainty of fitted parameters
+    
+    Noisy data sets are simulated from the model at popt with
+    proportional noise sigmap and constant noise sigmac, all at once,
+    and each one is fit in a pool of worker processes starting from
+    popt.
+    
+    Parameters
+    ----------
+    f, xdata, sigma, absolute_sigma, jac : as in curve_fit
+    popt : np.array
+        best fit parameters
+    sigmap : float
+        proportional noise, relative to the model
+    sigmac : float
+        constant noise
+    nreal : int
+        number of realizations
+    pcov : np.array
+        covariance from the original fit, kept for comparison
+    workers : int
+        number of worker processes. Zero uses every core and one fits
+        in this process.
+    seed : int
+        seed for the noise
+        
+    Returns
+    -------
+    MonteCarlo
+    
+    Example
+    -------
+    >>> mc = montecarlo(f, thr, popt, 0.05, 1e-4, 10000, pcov=pcov)
+    >>> print(mc.rms, np.sqrt(np.diag(mc.pcov)))
+    """
+    popt = np.asarray(popt, dtype=float)
+    model = np.asarray(f(xdata, *popt))
+    rng = np.random.RandomState(seed)
+    ydata = (model*(1+sigmap*rng.standard_normal((nreal, model.size)))+
+             sigmac*rng.standard_normal((nreal, model.size)))
+    kwargs = {'absolute_sigma': absolute_sigma}
+    if jac is not None:
+        kwargs['jac'] = jac
+    job = (f, xdata, ydata, sigma, kwargs, popt)
+    params = np.full((nreal, popt.size), np.nan)
+    for i, p in enumerate(_map(_refit, range(nreal),
+                               _workers(workers), job)):
+        if p is not None:
+            params[i] = p
+    return MonteCarlo(popt, pcov, params)
+
+class Bootstrap:
+    """ Parameter spread from fits to resampled data
+    
+    Attributes
+    ----------
+    popt : np.array
+        best fit parameters the replicates started from
+    params : np.array
+        (n, len(popt)) fitted parameters of each replicate. Rows of
+        fits that failed are nan.
+    n : int
+        number of replicates that were fit
+    converged : bool
+        True if the run stopped because the intervals converged
+    interval : np.array
+        (2, len(popt)) lower and upper percentile interval
+    mean : np.array
+        mean of the fitted parameters
+    rms : np.array
+        rms deviation of the fitted parameters from their mean
+    """
+    def __init__(self, popt, params, converged, interval):
+        self.popt = popt
+        self.params = params
+        self.n = params.shape[0]
+        self.converged = converged
+        self.interval = interval
+        ok = params[~np.any(np.isnan(params), axis=1)]
+        self.mean = np.mean(ok, axis=0)
+        self.rms = np.std(ok, axis=0)
+
+def _interval(params, alpha):
+    """percentile interval of the fits that succeeded, nan if none did"""
+    ok = params[~np.any(np.isnan(params), axis=1)]
+    if ok.shape[0]==0:
+        return np.full((2, params.shape[1]), np.nan)
+    return np.percentile(ok, [50*alpha, 100-50*alpha], axis=0)
+
+def bootstrap(f, xdata, ydata, popt, sigma=None, nboot: int = 1000,
+              mode: str = 'pairs', jac=None, absolute_sigma: bool = False,
+              alpha: float = 0.32, batch: int = 100, rtol: float = 0.02,
+              workers: int = 0, seed=None):
+    """Bootstrap estimate of the uncertainty of fitted parameters
+    
+    Replicate data sets are made by resampling the measured points
+    ('pairs') or the weighted residuals of the best fit ('residuals').
+    Each replicate is fit in a pool of worker processes starting from
+    popt. Replicates are fit in batches, and the run stops early once
+    the percentile intervals change by less than rtol of their width
+    from one batch to the next. RuntimeError is raised if none of the
+    replicates could be fit.
+    
+    Parameters
+    ----------
+    f, xdata, ydata, sigma, absolute_sigma, jac : as in curve_fit
+    popt : np.array
+        best fit parameters
+    nboot : int
+        largest number of replicates, at least one
+    mode : string
+        'pairs' or 'residuals'
+    alpha : float
+        the interval runs from the 100*alpha/2 to the 100*(1-alpha/2)
+        percentile. The default corresponds to one standard deviation.
+    batch : int
+        replicates fit between convergence checks
+    rtol : float
+        convergence tolerance, relative to the interval width. Zero
+        always fits all nboot replicates.
+    workers : int
+        number of worker processes. Zero uses every core and one fits
+        in this process.
+    seed : int
+        seed for the resampling
+        
+    Returns
+    -------
+    Bootstrap
+    
+    Example
+    -------
+    >>> bs = bootstrap(f, s18.ang, s18.rfl, popt, sigmaw, 2000)
+    >>> print(bs.interval, bs.n, bs.converged)
+    """
+    if mode not in ('pairs', 'residuals'):
+        raise ValueError("unknown bootstrap mode '"+str(mode)+"'")
+    if nboot < 1:
+        raise ValueError('nboot must be at least 1')
+    popt = np.asarray(popt, dtype=float)
+    xdata = np.asarray(xdata)
+    ydata = np.asarray(ydata, dtype=float)
+    if sigma is not None:
+        sigma = np.asarray(sigma, dtype=float)
+    model = np.asarray(f(xdata, *popt))
+    rng = np.random.RandomState(seed)
+    draws = rng.randint(0, ydata.size, (nboot, ydata.size))
+    kwargs = {'absolute_sigma': absolute_sigma}
+    if jac is not None:
+        kwargs['jac'] = jac
+    job = (f, xdata, ydata, sigma, kwargs, popt, mode, draws, model)
+    params = np.full((nboot, popt.size), np.nan)
+    workers = _workers(workers)
+    ex = _pool(workers, job) if workers > 1 else None
+    if ex is None:
+        _setjob(*job)
+    done = 0
+    converged = False
+    last = None
+    try:
+        while done < nboot:
+            ids = range(done, min(done+batch, nboot))
+            if ex is None:
+                fits = map(_bootfit, ids)
+            else:
+                fits = ex.map(_bootfit, ids,
+                              chunksize=max(1, len(ids)//(4*workers)))
+            for i, p in zip(ids, fits):
+                if p is not None:
+                    params[i] = p
+            done = ids.stop
+            interval = _interval(params[:done], alpha)
+            if last is not None and rtol > 0 and np.all(
+                    np.abs(interval-last) <= rtol*(last[1]-last[0])):
+                converged = True
+                break
+            last = interval
+    finally:
+        if ex is None:
+            _clearjob()
+        else:
+            ex.shutdown()
+    if np.all(np.isnan(interval)):
+        raise RuntimeError('none of the '+str(done)+
+                           ' bootstrap replicates could be fit')
+    return Bootstrap(popt, params[:done], converged, interval)
+
+def _seriesfit(i):
+    """warm-started curve_fits along series i of the job"""
+    f, series, sigma, kwargs, p0, warm = _job
+    if isinstance(f, (list, tuple)):
+        f = f[i]
+    p = np.asarray(p0, dtype=float)
+    rows = []
+    for r in series[i]:
+        s = None if sigma is None else sigma(r.ang, r.rfl)
+        try:
+            popt, pcov, info = curve_fit(f, r.ang, r.rfl, p, s,
+                                         full_output=True, **kwargs)[:3]
+        except (RuntimeError, ValueError):
+            rows.append(None)
+            continue
+        res = np.asarray(f(r.ang, *popt))-r.rfl
+        if s is not None:
+            res = res/s
+        rows.append((popt, np.sqrt(np.diag(pcov)), np.sum(res**2),
+                     info['nfev']))
+        if warm:
+            p = popt
+    return rows
+
+class Series:
+    """ Fitted parameters of a series of measurements of one sample
+    
+    Attributes
+    ----------
+    times : np.array
+        time (or other label) of each measurement
+    params : np.array
+        (len(times), nparams) fitted parameters. Rows of fits that
+        failed are nan.
+    errors : np.array
+        uncertainties of the parameters from the covariance of each fit
+    chi2 : np.array
+        chi**2 of each fit
+    nfev : np.array
+        number of function evaluations of each fit (0 if it failed)
+    """
+    def __init__(self, times, rows, nparams):
+        self.times = np.asarray(times)
+        n = len(rows)
+        self.params = np.full((n, nparams), np.nan)
+        self.errors = np.full((n, nparams), np.nan)
+        self.chi2 = np.full(n, np.nan)
+        self.nfev = np.zeros(n, dtype=int)
+        for i, row in enumerate(rows):
+            if row is not None:
+                (self.params[i], self.errors[i], self.chi2[i],
+                 self.nfev[i]) = row
+
+def fitseries(f, series, p0, times=None, sigma=None, jac=None,
+              bounds=None, absolute_sigma: bool = False, warm: bool = True,
+              workers: int = 0):
+    """Fit series of spectra, each fit starting from the one before
+    
+    Each spectrum of a series is fit starting from the parameters of
+    the previous successful fit. This takes fewer iterations than starting each
+    fit from p0 and keeps the thickness on the same fringe from one
+    measurement to the next. Independent series are fit in a pool of
+    worker processes.
+    
+    Parameters
+    ----------
+    f : function or list of functions
+        fit function, or one per series (such as refl.Stack)
+    series : list of lists of refl.Reflectance
+        the spectra of each series, in order
+    p0 : np.array
+        starting parameters of the first fit of every series
+    times : list of arrays
+        time of each measurement of each series. By default (or if the
+        times of a series are None) the measurements are numbered.
+    sigma : function
+        sigma(ang, rfl) gives the uncertainty of each point, or None
+        for equal weights
+    jac, bounds, absolute_sigma : as in curve_fit
+    warm : bool
+        start each fit from the one before; if False every fit starts
+        from p0
+    workers : int
+        number of worker processes. Zero uses every core and one fits
+        in this process.
+        
+    Returns
+    -------
+    list of Series, one per series
+    
+    Example
+    -------
+    >>> f = refl.Stack(layers, 15)
+    >>> oxide, = fitseries(f, [[s0, s1, s2, s3]], f.p0, [days],
+    ...                    lambda ang, rfl: 0.2*rfl+5e-5, f.jac, f.bounds)
+    >>> plt.errorbar(oxide.times, oxide.params[:,2], oxide.errors[:,2])
+    """
+    kwargs = {'absolute_sigma': absolute_sigma}
+    if jac is not None:
+        kwargs['jac'] = jac
+    if bounds is not None:
+        kwargs['bounds'] = bounds
+    if times is None:
+        times = [None]*len(series)
+    times = [np.arange(len(s)) if t is None else t
+             for s, t in zip(series, times)]
+    job = (f, series, sigma, kwargs, p0, warm)
+    workers = min(_workers(workers), max(len(series), 1))
+    results = _map(_seriesfit, range(len(series)), workers, job)
+    return [Series(t, rows, len(p0)) for t, rows in zip(times, results)]
+
+class LiveFit:
+    """ Refit a spectrum while its run is being measured
+    
+    Each update reads the new rows of the run, merges them into a
+    growing spectrum and, once every new points have arrived, refits
+    it on a background thread starting from the last result. With
+    start, updates are made on a thread of their own until stop.
+    
+    Constructor Parameters
+    ----------------------
+    tail : refl.RunTail
+        the run being measured
+    i0run : refl.Run
+        run with the direct beam data
+    dark : tuple of float or refl.Calibration
+        dark currents, as for refl.Reflectance
+    f : function
+        fit function f(thetad, *p), such as a refl.Stack
+    p0 : np.array
+        starting parameters of the first fit
+    every : int
+        number of new points between fits
+    sigma : function
+        sigma(ang, rfl) gives the uncertainty of each point, or None
+        for equal weights
+    callback : function
+        if given, called with this LiveFit after every fit
+    kwargs :
+        passed on to curve_fit, for example jac and bounds
+        
+    Attributes
+    ----------
+    spectrum : refl.Reflectance
+        all points read so far, sorted by angle
+    popt, pcov : np.array
+        result of the last fit (pcov is None before the first fit)
+    npts : int
+        number of points in the last fit
+    error : Exception
+        error of the last fit, or None if it succeeded
+        
+    Example
+    -------
+    f = refl.Stack(layers, log.wavelength[122])
+    live = LiveFit(refl.RunTail(log, 122), runs[97], dark, f, f.p0, 25,
+                   lambda ang, rfl: 0.2*rfl+5e-5, jac=f.jac,
+                   callback=lambda fit: print(fit.npts, fit.popt))
+    live.start()
+    ...
+    live.stop()
+    """
+    def __init__(self, tail, i0run, dark, f, p0, every: int = 20,
+                 sigma=None, callback=None, **kwargs):
+        self.tail = tail
+        self.i0run = i0run
+        self.dark = dark
+        self.f = f
+        self.every = every
+        self.sigma = sigma
+        self.callback = callback
+        self.kwargs = kwargs
+        self.spectrum = refl.Reflectance()
+        self.popt = np.asarray(p0, dtype=float)
+        self.pcov = None
+        self.npts = 0
+        self.error = None
+        self._submitted = 0
+        self._lock = threading.Lock()
+        self._fitter = ThreadPoolExecutor(max_workers=1)
+        self._fitting = None
+        self._stop = threading.Event()
+        self._thread = None
+    def update(self):
+        """read new points and start a refit if enough have arrived;
+        returns the number of points in the spectrum"""
+        new = self.tail.read()
+        with self._lock:
+            if new is not None:
+                self.spectrum.extend(refl.Reflectance((new,), self.i0run,
+                                                      self.dark))
+            npts = self.spectrum.ang.size
+        if (npts-self._submitted>=self.every and
+                (self._fitting is None or self._fitting.done())):
+            self._submitted = npts
+            self._fitting = self._fitter.submit(self._fit)
+        return npts
+    def _fit(self):
+        with self._lock:
+            ang = self.spectrum.ang.copy()
+            rfl = self.spectrum.rfl.copy()
+        sigma = None if self.sigma is None else self.sigma(ang, rfl)
+        try:
+            self.popt, self.pcov = curve_fit(self.f, ang, rfl, self.popt,
+                                             sigma, **self.kwargs)
+            self.error = None
+        except (RuntimeError, ValueError) as e:
+            self.error = e
+        self.npts = ang.size
+        if self.callback is not None:
+            self.callback(self)
+    def wait(self):
+        """wait for the current fit to finish"""
+        if self._fitting is not None:
+            self._fitting.result()
+    def start(self, interval: float = 1.0):
+        """update every interval seconds on a background thread"""
+        self._stop.clear()
+        def poll():
+            while not self._stop.wait(interval):
+                self.update()
+        self._thread = threading.Thread(target=poll, daemon=True)
+        self._thread.start()
+    def stop(self):
+        """stop updating and fit every point read"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.update()
+        self.wait()
+        if self.spectrum.ang.size>self._submitted:
+            self._submitted = self.spectrum.ang.size
+            self._fitting = self._fitter.submit(self._fit)
+            self.wait()
@@ -7,19 +7,14 @@ Created on Wed Aug  5 02:11:09 2015
 
 # Example reading a CSV file from ALS
 import csv
+import numpy as np
 import matplotlib.pyplot as plt
 
 def alsdata(filename):
-    pos=[];
-    detector=[];
-    with open(filename, newline='') as f:
-        header=f.readline(); # skip header
-        reader = csv.reader(f, delimiter='\t')
-        for row in reader:
-            pos.append(float(row[0]));
-            signal = float(row[1]);
-            current = float(row[3]);
-            detector.append(signal*current/500);
+    # all columns are read at once; 0 is position, 1 signal, 3 current
+    data = np.loadtxt(filename, delimiter='\t', skiprows=1, ndmin=2)
+    pos = data[:,0]
+    detector = data[:,1]*data[:,3]/500
     return (pos, detector)
 
 def savedata(filename, y, d):
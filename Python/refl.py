@@ -14,11 +14,96 @@ Created on Tue Aug  4 15:45:52 2015
 # agreed to within 6 significant digits. I attribute the difference to
 # interpolation differences.
 
+import os
+import sys
+import json
+import math
+import bisect
+import time
+import tempfile
+import functools
+import threading
+import warnings
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 import numpy as np
 import scipy.interpolate as intp
+import scipy.special as special
+import scipy.sparse as sparse
+from scipy.optimize import least_squares
+from scipy.optimize import curve_fit as _curve_fit
 import matplotlib.pyplot as plt
 
-def matR(n, t, thetad, lam, sigma=0):
+def _chain(M):
+    """Ordered product M[...,0,:,:] @ M[...,1,:,:] @ ... of a stack of
+    2x2 matrices, reduced pairwise over the layer axis (axis -3)"""
+    while M.shape[-3] > 1:
+        P = np.matmul(M[...,0:-1:2,:,:], M[...,1::2,:,:])
+        if M.shape[-3] % 2:
+            P = np.concatenate((P, M[...,-1:,:,:]), axis=-3)
+        M = P
+    return M[...,0,:,:]
+
+def matAmplitudes(n, t, thetad, lam):
+    """Complex reflection and transmission amplitudes from a multilayer
+    mirror using transfer matrices
+    
+    The interface matrices for both polarizations and all layers are
+    built as one (2, ..., layers-1, 2, 2) array and multiplied together
+    with a batched product.
+    
+    Parameters
+    ----------
+    n : array of numbers
+        index of refraction of the various layers, starting
+        with vacuum. Layers run along the last axis; any leading
+        axes broadcast against thetad and lam.
+    t : array of numbers
+        thickness of the various layers, starting with vacuum.
+        The thickness of the vacuum and substrate should be 0.
+    thetad : number or np.array
+        incident angle in degrees
+    lam : number or np.array
+        wavelength in nm
+    
+    Returns
+    -------
+    tuple with rs, rp, ts, tp
+    
+    Example
+    -------
+    >>> rs, rp, ts, tp = matAmplitudes(n, t, np.linspace(1, 80, 160), 30.4)
+    """
+    n = np.asarray(n)
+    t = np.asarray(t)
+    lam = np.asarray(lam, dtype=float)[..., np.newaxis]
+    th = np.asarray(thetad, dtype=float)[..., np.newaxis]*np.pi/180
+    ky = 2*np.pi*np.cos(th)/lam
+    kz = np.sqrt((2*np.pi*n/lam)**2-ky**2+0j)
+    C = np.exp(1j*kz*t/2)
+    n1, n2 = n[...,:-1], n[...,1:]
+    kz1, kz2 = kz[...,:-1], kz[...,1:]
+    C1, C2 = C[...,:-1], C[...,1:]
+    # s polarization in f[0], g[0], p polarization in f[1], g[1]
+    f12 = np.array(np.broadcast_arrays((kz1-kz2)/(kz1+kz2),
+            (n2**2*kz1-n1**2*kz2)/(n1**2*kz2+n2**2*kz1)))
+    g12 = np.array(np.broadcast_arrays(2*kz1/(kz1+kz2),
+            2*n1*n2*kz1/(n1**2*kz2+n2**2*kz1)))
+    g21 = np.array(np.broadcast_arrays(2*kz2/(kz1+kz2),
+            2*n1*n2*kz2/(n1**2*kz2+n2**2*kz1)))
+    f21 = -f12
+    M = np.empty(f12.shape+(2,2), dtype=complex)
+    M[...,0,0] = g21*C1*C2-f21*f12*C1*C2/g12
+    M[...,0,1] = f12*C1/(g12*C2)
+    M[...,1,0] = -f21*C2/(g12*C1)
+    M[...,1,1] = 1/(g12*C1*C2)
+    A = _chain(M)
+    tr = 1/A[...,1,1]
+    r = tr*A[...,0,1]
+    return (r[0], r[1], tr[0], tr[1])
+
+def matR(n, t, thetad, lam, sigma=0, fractions=0):
     """Reflectance and transmittance form a multilayer mirror
     
     Parameters
@@ -29,10 +114,14 @@ def matR(n, t, thetad, lam, sigma=0):
     t : array of numbers
         thickness of the various layers, starting with vacuum.
         The thickness of the vacuum and substrate should be 0.
-    thetad: number
+    thetad: number or np.array
         incident angle in degrees
     sigma: array of numbers
         roughness at each interace, starting with vacumm/top layer
+    fractions : number, string or Polarization
+        fraction of s polarization, or the polarization profile to
+        find it from. If zero, the default profile is used, with light
+        outside of its table taken as s polarized.
     
     Returns
     -------
@@ -42,83 +131,177 @@ def matR(n, t, thetad, lam, sigma=0):
     -------
     >>> matR(n, t, 45, 30.4, sigma)
     """
-    ky=2*np.pi*np.cos(thetad*np.pi/180)/lam
-    ki = lambda ni : 2*np.pi*ni/lam
-    kzi = lambda ni : np.sqrt(ki(ni)**2-ky**2)
-    Ci = lambda ni, di : np.exp(np.complex(0, kzi(ni))*di/2)
-    def rmats(n1, n2, d1, d2):
-        kz1=kzi(n1)
-        kz2=kzi(n2)
-        fs12=(kz1-kz2)/(kz1+kz2)
-        gs12=2*kz1/(kz1+kz2)
-        fs21=-fs12
-        gs21=2*kz2/(kz1+kz2)
-        C1=Ci(n1,d1)
-        C2=Ci(n2,d2)
-        return np.array([[gs21*C1*C2-fs21*fs12*C1*C2/gs12,
-                          fs12*C1/(gs12*C2)],
-                        [-fs21*C2/(gs12*C1),
-                         1/(gs12*C1*C2)]])
-    def rmatp(n1, n2, d1, d2):
-        kz1=kzi(n1)
-        kz2=kzi(n2)
-        fp12=(n2**2*kz1-n1**2*kz2)/(n1**2*kz2+n2**2*kz1)
-        gp12=2*n1*n2*kz1/(n1**2*kz2+n2**2*kz1)
-        fp21=-fp12
-        gp21=2*n1*n2*kz2/(n1**2*kz2+n2**2*kz1)
-        C1=Ci(n1,d1)
-        C2=Ci(n2,d2)
-        return np.array([[gp21*C1*C2-fp21*fp12*C1*C2/gp12,
-                          fp12*C1/(gp12*C2)],
-                        [-fp21*C2/(gp12*C1),
-                         1/(gp12*C1*C2)]])
-    A=np.identity(2)
-    B=A
-    for i in range(n.size-1,0,-1):
-        A=np.matmul(rmats(n[i-1], n[i], t[i-1], t[i]),A)
-        B=np.matmul(rmatp(n[i-1], n[i], t[i-1], t[i]),B)
-#        print("When i="+str(i))
-#        print("   A="+str(A))
-#        print("   B="+str(B))
-    ts=1/A[1,1]
-    rs=ts*A[0,1]
-    tp=1/B[1,1]
-    rp=tp*B[0,1]
-    try:
-        percentS=fracs(lam)
-    except ValueError:
-        percentS=1.0
+    rs, rp, ts, tp = matAmplitudes(n, t, thetad, lam)
+    percentS=_fractions(fractions, lam, 1.0)
     r=percentS*np.abs(rs)**2+(1-percentS)*np.abs(rp)**2
     # This assumes starting and ending materials are the same
     t=percentS*np.abs(ts)**2+(1-percentS)*np.abs(tp)**2
     return (r,t)
 
-def Parratt(n, x, thetad, lam, fractions=0, sigma=0.0):
+def _changed(old, new):
+    """layers (last axis) where any element differs"""
+    return np.any(old!=new, axis=tuple(range(np.ndim(new)-1)))
+
+class ParrattCache:
+    """ Reflection amplitudes of a stack from the last Parratt call
+    
+    In most fits only the top one or two layers change. Passing the same
+    ParrattCache to every Parratt call lets the recursion start from the
+    deepest layer whose index, thickness or roughness changed, reusing
+    the s and p amplitudes of the fixed layers below it. The results are
+    the same as without the cache. A cache should be used for one stack
+    at a time and not shared between threads.
+    
+    Example
+    -------
+    >>> cache = ParrattCache()
+    >>> def f(thr, n, k, t):
+    ...     ndx = np.array([1+0j, n+k*1j, alndx, sio2ndx, sindx])
+    ...     th = np.array([0, t, 50, 1.6, 0])
+    ...     return Parratt(ndx, th, thr, wl, cache=cache)
+    """
+    def __init__(self):
+        self.key = None
+        self.rs = []
+        self.rp = []
+    def _restart(self, n, x, sigma, thetad, lam, roughness):
+        """first recursion step to compute and its input amplitudes"""
+        nl = n.shape[-1]
+        thetad = np.asarray(thetad, dtype=float)
+        lam = np.asarray(lam, dtype=float)
+        key = self.key
+        if (key is None or key[0].shape!=n.shape or
+                key[1].shape!=x.shape or key[2].shape!=sigma.shape or
+                not np.array_equal(key[3], thetad) or
+                not np.array_equal(key[4], lam) or key[5]!=roughness):
+            top = nl-1
+        else:
+            changed = _changed(key[0], n) | _changed(key[1], x)
+            changed[:-1] |= _changed(key[2], sigma)
+            deepest = np.flatnonzero(changed)
+            top = min(deepest[-1]+1, nl-1) if deepest.size else 0
+        self.key = (n.copy(), x.copy(), sigma.copy(), thetad.copy(),
+                    lam.copy(), roughness)
+        if top==nl-1:
+            self.rs = [0]*nl
+            self.rp = [0]*nl
+            return (top, 0, 0)
+        return (top, self.rs[top+1], self.rp[top+1])
+
+def graded(n, x, sigma, nslice: int = 16, width: float = 3.0):
+    """Slice rough interfaces into thin layers with a graded index
+    
+    The index of refraction through the stack is taken to be
+    n(z) = n[0] + sum over interfaces of (n[m]-n[m-1])*P((z-z[m])/sigma[m])
+    where z[m] is the top of layer m and P the normal cumulative
+    distribution (an error function profile). Each interface with
+    nonzero roughness is replaced by nslice layers of equal thickness
+    spanning width*sigma on either side of it, with the index of the
+    profile at the middle of each. A span is cut short at the middle of
+    a layer thinner than the spans of its two interfaces, so they never
+    overlap. Everything is done with array operations, so stacks of
+    thousands of sublayers are built at once.
+    
+    Parameters
+    ----------
+    n : np.array
+        index of each layer starting with the incident layer. Leading
+        axes (e.g. wavelength) are kept.
+    x : np.array
+        thickness of each layer; the incident and substrate thicknesses
+        are ignored
+    sigma : np.array
+        rms roughness of each interface, nl-1 of them
+    nslice : int
+        number of sublayers for each rough interface
+    width : float
+        half width of the sliced region in units of sigma
+        
+    Returns
+    -------
+    (n, x) : np.array
+        the index and thickness of the sliced stack, for Parratt
+        
+    Example
+    -------
+    >>> ns, xs = graded(n, t, [0.5, 1.0], 20)
+    >>> Parratt(ns, xs, thr, lam)
+    """
+    n = np.asarray(n)
+    x = np.asarray(x, dtype=float)
+    nl = n.shape[-1]
+    sigma = np.zeros(nl-1)+sigma
+    # interface m-1 is at the top of layer m, z[m-1]
+    z = np.concatenate(([0], np.cumsum(x[1:-1])))
+    room = np.concatenate((x[1:-1]/2, [np.inf]))
+    half = np.minimum(width*sigma, np.minimum(np.r_[np.inf, room[:-1]],
+                                              room))
+    # (interface, slice) thicknesses and midpoints
+    dz = 2*half/nslice
+    mid = (z-half)[:,np.newaxis]+dz[:,np.newaxis]*(np.arange(nslice)+0.5)
+    rough = sigma>0
+    u = ((mid.ravel()[:,np.newaxis]-z[rough])/
+         (np.sqrt(2)*sigma[rough]))
+    steps = (mid.ravel()[:,np.newaxis]>z)*1.0
+    steps[:,rough] = (1+special.erf(u))/2
+    dn = np.diff(n, axis=-1)
+    nmid = (n[...,:1]+dn@steps.T).reshape(n.shape[:-1]+(nl-1, nslice))
+    # each layer after the incident one: its interface slices, then
+    # what is left of the layer
+    core = x[1:]-half-np.r_[half[1:], 0]
+    core[-1] = 0
+    xs = np.concatenate((np.broadcast_to(dz[:,np.newaxis], (nl-1, nslice)),
+                         core[:,np.newaxis]), axis=1)
+    ns = np.concatenate((nmid, n[...,1:,np.newaxis]), axis=-1)
+    keep = np.concatenate((np.broadcast_to(rough[:,np.newaxis],
+                                           (nl-1, nslice)),
+                           np.ones((nl-1, 1), dtype=bool)), axis=1).ravel()
+    ns = ns.reshape(n.shape[:-1]+(-1,))[...,keep]
+    xs = xs.ravel()[keep]
+    return (np.concatenate((n[...,:1], ns), axis=-1),
+            np.concatenate(([0], xs)))
+
+def Parratt(n, x, thetad, lam, fractions=0, sigma=0.0, cache=None,
+            roughness: str = 'debye-waller', nslice: int = 16):
     """Reflectance from a multilayer mirror
     
     Parameters
     ----------
     n : np.array of index of refractions for stack starting with 
-        index of the incident layer
+        index of the incident layer. Layers run along the last axis;
+        any leading axes (e.g. wavelength) broadcast against thetad.
     x : np.array of layer thicknesses for stack starting with
         the thickness of the incident layer (usually vacuum).
         The vacuum and substrate thicknesses should be set to
         0.
-    thetad : number
-        incident angle in degrees
-    lam : number
-        wavelength in nanometers
-    fractions : number
+    thetad : number or np.array
+        incident angle in degrees. If an array of angles is given,
+        the recursion is done once for all of them.
+    lam : number or np.array
+        wavelength in nanometers, broadcast against thetad
+    fractions : number or np.array
         fraction of light with s polarization. If zero, this is calculated
-        using Gullikson formula for synchrotron
+        using Gullikson formula for synchrotron. It may also be the name
+        of a polarization profile (see Polarization). Models called
+        many times should find the fraction once and pass it here.
     sigma : array of number
         interface roughness in nm
+    cache : ParrattCache
+        if given, the amplitudes of the lower layers are kept from one
+        call to the next, and the recursion restarts from the deepest
+        layer that changed
+    roughness : string
+        'debye-waller' or 'nevot-croce' to damp the Fresnel coefficient
+        of each rough interface, or 'graded' to slice each rough
+        interface into nslice layers with graded (see graded)
+    nslice : int
+        number of sublayers of each rough interface for 'graded'
         
     Returns
     -------
-    ref: number
-        reflectance of the layer for s polarization
-        
+    ref: number or np.array
+        reflectance of the layer at each angle in thetad
+    
     Example
     -------
     >>> lam = 15
@@ -131,27 +314,64 @@ def Parratt(n, x, thetad, lam, fractions=0, sigma=0.0):
     >>> thetad = 20
     >>> Parratt(n, t, thetad, lam)
     0.012606490280013215
+    >>> Parratt(n, t, np.linspace(1, 80, 160), lam)
+    array([...])
     """
-    if fractions==0:
-        fractions = fracs(lam)
+    fractions = _fractions(fractions, lam)
     fractionp = 1-fractions
-    S = np.sqrt(n**2-np.cos(thetad*np.pi/180)**2)
-    k = 2*np.pi/lam
-    C = np.exp(2j*S*x*k)
+    n = np.asarray(n)
+    x = np.asarray(x)
+    nl = n.shape[-1]
+    sigma = np.zeros(nl-1)+sigma
+    if roughness not in ('debye-waller', 'nevot-croce', 'graded'):
+        raise ValueError('unknown roughness model '+str(roughness))
+    if roughness=='graded':
+        n, x = graded(n, x, sigma, nslice)
+        nl = n.shape[-1]
+        sigma = np.zeros(nl-1)
+        roughness = 'debye-waller'
+    # the recursion runs from step top down to 1; step m joins layers
+    # m-1 and m
+    top = nl-1
     rs = 0
     rp = 0
-    
-    qz = k*np.sin(thetad*np.pi/180) # for Debye-Waller correction
-    if sigma == 0:
-        sigma = np.zeros(n.size-1)
-    eta = np.exp(-2*qz**2*sigma**2) # Debye-Waller roughness correction
-    
-    for m in range(n.size-1, 0,-1):
-        fs = (S[m-1]-S[m])/(S[m-1]+S[m])
-        fp = ((n[m]**2 * S[m-1] - n[m-1]**2 * S[m])/
-              (n[m]**2 * S[m-1] + n[m-1]**2 * S[m]))
-        rs = C[m-1]*(fs*eta[m-1]+rs*eta[m-1]**2)/(1+fs*rs*eta[m-1])
-        rp = C[m-1]*(fp*eta[m-1]+rp*eta[m-1]**2)/(1+fp*rp*eta[m-1])
+    if cache is not None:
+        top, rs, rp = cache._restart(n, x, sigma, thetad, lam, roughness)
+    # angles and wavelengths run along the leading axes, layers along
+    # the last one
+    th = np.asarray(thetad, dtype=float)[..., np.newaxis]*np.pi/180
+    n2 = n[...,:top+1]**2
+    S = np.sqrt(n2-np.cos(th)**2)
+    k = 2*np.pi/np.asarray(lam, dtype=float)[..., np.newaxis]
+    C = np.exp(2j*S[...,:-1]*x[...,:top]*k)
+    # the Fresnel coefficients of all interfaces are found at once, so
+    # each step of the recursion is rs = (C*fs+b*rs)/(1+fs*rs), with
+    # the layers on the first axis
+    fs = (S[...,:-1]-S[...,1:])/(S[...,:-1]+S[...,1:])
+    fp = ((n2[...,1:]*S[...,:-1]-n2[...,:-1]*S[...,1:])/
+          (n2[...,1:]*S[...,:-1]+n2[...,:-1]*S[...,1:]))
+    b = C
+    if np.any(sigma[...,:top]):
+        if roughness=='debye-waller':
+            qz = k*np.sin(th)
+            eta = np.exp(-2*qz**2*sigma[...,:top]**2)
+        else:
+            eta = np.exp(-2*k**2*S[...,:-1]*S[...,1:]*sigma[...,:top]**2)
+        fs = fs*eta
+        fp = fp*eta
+        b = C*eta**2
+    first = lambda a: np.ascontiguousarray(np.moveaxis(a, -1, 0))
+    b = first(b)
+    ds = first(fs)
+    dp = first(fp)
+    cfs = first(C*fs)
+    cfp = first(C*fp)
+    for m in range(top, 0,-1):
+        rs = (cfs[m-1]+b[m-1]*rs)/(1+ds[m-1]*rs)
+        rp = (cfp[m-1]+b[m-1]*rp)/(1+dp[m-1]*rp)
+        if cache is not None:
+            cache.rs[m] = rs
+            cache.rp[m] = rp
     return fractionp*np.abs(rp)**2+fractions*np.abs(rs)**2
      
 # =============================================================================
@@ -180,6 +400,170 @@ def Parratt(n, x, thetad, lam, fractions=0, sigma=0.0):
 # return;
 # =============================================================================
 
+def ParrattJac(n, x, thetad, lam, fractions=0, sigma=0.0):
+    """Reflectance from a multilayer mirror and its derivatives with
+    respect to the index, thickness and roughness of every layer
+    
+    The derivatives are carried through the Parratt recursion by forward
+    differentiation, so they are exact and cost about as much as a few
+    extra reflectance evaluations.
+    
+    Parameters
+    ----------
+    n, x, thetad, lam, fractions, sigma : as in Parratt
+        
+    Returns
+    -------
+    tuple with
+    ref : number or np.array
+        reflectance, as returned by Parratt
+    dn : np.array
+        derivative of ref with respect to the real part of each index.
+        The layer runs along the last axis.
+    dk : np.array
+        derivative of ref with respect to the imaginary part of each
+        index
+    dx : np.array
+        derivative of ref with respect to each layer thickness
+    dsigma : np.array
+        derivative of ref with respect to each interface roughness
+    
+    Example
+    -------
+    >>> r, dn, dk, dx, ds = ParrattJac(n, t, np.linspace(1, 80, 160), 15)
+    >>> dx[:,1] # derivative with respect to the top layer thickness
+    """
+    fractions = _fractions(fractions, lam)
+    fractionp = 1-fractions
+    n = np.asarray(n)
+    x = np.asarray(x)
+    nl = n.shape[-1]
+    th = np.asarray(thetad, dtype=float)[..., np.newaxis]*np.pi/180
+    S = np.sqrt(n**2-np.cos(th)**2)
+    k = 2*np.pi/np.asarray(lam, dtype=float)[..., np.newaxis]
+    C = np.exp(2j*S*x*k)
+    dSdn = n/S
+    dCdn = 2j*x*k*dSdn*C
+    dCdx = 2j*S*k*C
+    
+    qz = k*np.sin(th) # for Debye-Waller correction
+    sigma = np.zeros(nl-1)+sigma
+    eta = np.exp(-2*qz**2*sigma**2) # Debye-Waller roughness correction
+    deta = -4*qz**2*sigma*eta
+    
+    shape = np.broadcast(S, C).shape
+    r = [0, 0] # s and p amplitudes
+    # complex derivatives of the amplitudes: the amplitudes are analytic
+    # in the index, so d/dk is 1j*d/dn
+    drn = [np.zeros(shape, complex), np.zeros(shape, complex)]
+    drx = [np.zeros(shape, complex), np.zeros(shape, complex)]
+    drs = [np.zeros(shape[:-1]+(nl-1,), complex) for p in range(2)]
+    for m in range(nl-1, 0,-1):
+        S1, S2 = S[...,m-1], S[...,m]
+        n1, n2 = n[...,m-1], n[...,m]
+        fs = (S1-S2)/(S1+S2)
+        dfs1 = 2*S2/(S1+S2)**2*dSdn[...,m-1]
+        dfs2 = -2*S1/(S1+S2)**2*dSdn[...,m]
+        a = n2**2*S1
+        b = n1**2*S2
+        fp = (a-b)/(a+b)
+        dfpa = 2*b/(a+b)**2
+        dfpb = -2*a/(a+b)**2
+        dfp1 = dfpa*n2**2*dSdn[...,m-1]+dfpb*2*n1*S2
+        dfp2 = dfpa*2*n2*S1+dfpb*n1**2*dSdn[...,m]
+        e = eta[...,m-1]
+        Cm = C[...,m-1]
+        for p, (f, df1, df2) in enumerate(((fs, dfs1, dfs2),
+                                           (fp, dfp1, dfp2))):
+            rr = r[p]
+            num = f*e+rr*e**2
+            den = 1+f*rr*e
+            g = num/den
+            gr = Cm*(e**2*den-num*f*e)/den**2
+            gf = Cm*(e*den-num*rr*e)/den**2
+            ge = Cm*((f+2*rr*e)*den-num*f*rr)/den**2
+            drn[p] = gr[...,np.newaxis]*drn[p]
+            drx[p] = gr[...,np.newaxis]*drx[p]
+            drs[p] = gr[...,np.newaxis]*drs[p]
+            drn[p][...,m-1] += gf*df1+dCdn[...,m-1]*g
+            drn[p][...,m] += gf*df2
+            drx[p][...,m-1] += dCdx[...,m-1]*g
+            drs[p][...,m-1] += ge*deta[...,m-1]
+            r[p] = Cm*g
+    rs, rp = r
+    ref = fractionp*np.abs(rp)**2+fractions*np.abs(rs)**2
+    fs = np.asarray(fractions)[...,np.newaxis]
+    fp = np.asarray(fractionp)[...,np.newaxis]
+    cs = 2*np.conj(rs)[...,np.newaxis]
+    cp = 2*np.conj(rp)[...,np.newaxis]
+    dn = fs*np.real(cs*drn[0])+fp*np.real(cp*drn[1])
+    dk = -fs*np.imag(cs*drn[0])-fp*np.imag(cp*drn[1])
+    dx = fs*np.real(cs*drx[0])+fp*np.real(cp*drx[1])
+    dsigma = fs*np.real(cs*drs[0])+fp*np.real(cp*drs[1])
+    return (ref, dn, dk, dx, dsigma)
+
+def ParrattFit(n, x, lam, free, fractions=0, sigma=0.0):
+    """Model and Jacobian functions for curve_fit with some of the
+    stack parameters free
+    
+    Parameters
+    ----------
+    n, x, lam, fractions, sigma : as in Parratt
+        starting values for the stack. The free parameters are
+        overwritten with the fit parameters on every call.
+    free : list of tuple
+        the free parameters in the order curve_fit sees them. Each is
+        (kind, layer) where kind is 'n' (real part of the index),
+        'k' (imaginary part), 'x' (thickness) or 'sigma' (roughness
+        of the interface on top of layer+1).
+        
+    Returns
+    -------
+    tuple with
+    f : function
+        f(thetad, *p) returning the reflectance
+    jac : function
+        jac(thetad, *p) returning the (thetad.size, len(p)) Jacobian,
+        suitable for the jac argument of curve_fit
+        
+    Example
+    -------
+    >>> ndx = np.array([1+0j, alf3ndx, alndx, sio2ndx, sindx])
+    >>> th = np.array([0, 18, 50, 1.6, 0])
+    >>> f, jac = ParrattFit(ndx, th, 12, [('n',1), ('k',1), ('x',1)])
+    >>> popt, pcov = curve_fit(f, thr, refn, p0, sigma, jac=jac)
+    """
+    n = np.array(n, dtype=complex)
+    x = np.array(x, dtype=float)
+    sigma = np.zeros(n.size-1)+sigma
+    kinds = ('n', 'k', 'x', 'sigma')
+    for kind, layer in free:
+        if kind not in kinds:
+            raise ValueError("unknown parameter kind '"+str(kind)+"'")
+    def stack(p):
+        ndx = n.copy()
+        th = x.copy()
+        sg = sigma.copy()
+        for (kind, layer), v in zip(free, p):
+            if kind=='n':
+                ndx[layer] = v+1j*ndx[layer].imag
+            elif kind=='k':
+                ndx[layer] = ndx[layer].real+1j*v
+            elif kind=='x':
+                th[layer] = v
+            else:
+                sg[layer] = v
+        return (ndx, th, sg)
+    def f(thetad, *p):
+        ndx, th, sg = stack(p)
+        return Parratt(ndx, th, thetad, lam, fractions, sg)
+    def jac(thetad, *p):
+        ndx, th, sg = stack(p)
+        d = ParrattJac(ndx, th, thetad, lam, fractions, sg)[1:]
+        return np.stack([d[kinds.index(kind)][...,layer]
+                         for kind, layer in free], axis=-1)
+    return (f, jac)
+
 ipts = np.array([[1.05685E+1,9.37888E-1],
                  [1.40446E+1,9.26536E-1],
                  [1.75270E+1,9.15094E-1],
@@ -203,13 +587,279 @@ ipts = np.array([[1.05685E+1,9.37888E-1],
 xfr=ipts[:,0]
 yfr=ipts[:,1]
 frfunc=intp.interp1d(np.log10(xfr),yfr,'cubic')
-def fracs(lam):
+
+# Where .nk files come from: the volta server, a persistent cache of
+# what has been downloaded and the files bundled with this module
+nkurl = "http://volta.byu.edu/nk/"
+nkcache = os.environ.get('REFL_NK_CACHE',
+                         os.path.join(os.path.expanduser('~'), '.refl', 'nk'))
+nkbundled = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nk')
+
+_nktables = {}
+_nklock = threading.Lock()
+
+def _readnk(text):
+    """wavelength in nm and complex index from the text of a .nk file"""
+    val = np.loadtxt(text.splitlines(), comments=';', ndmin=2)
+    return (val[:,0]/10, val[:,1]+val[:,2]*1j)
+
+def _savenk(cached, text):
+    """write a .nk file to the cache atomically, so another process
+    never reads it half written"""
+    try:
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(suffix='.tmp',
+                                   dir=os.path.dirname(cached))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(text)
+            os.replace(tmp, cached)
+        except OSError:
+            os.remove(tmp)
+            raise
+    except OSError:
+        pass # a read-only cache is not fatal
+
+def nkTable(material):
+    """Tabulated index of refraction for a material
+    
+    The table is parsed once per process. It is read from the cache
+    directory nkcache if it was loaded before, otherwise from volta
+    and, if volta can't be reached or sends something that is not a
+    .nk file, from the files bundled in nkbundled. Either way it is
+    saved in the cache, so later processes don't go to volta again.
+    
+    Parameters
+    ----------
+    material : string
+        material from base of .nk file on volta
+        
+    Returns
+    -------
+    tuple with
+    lam : np.array
+        wavelengths in nm
+    ndx : np.array
+        complex index of refraction at each wavelength
+    
+    Example
+    -------
+    >>> lam, ndx = nkTable('Al')
+    """
+    with _nklock:
+        if material in _nktables:
+            return _nktables[material]
+    fname = material+'.nk'
+    cached = os.path.join(nkcache, fname)
+    if os.path.isfile(cached):
+        with open(cached) as f:
+            table = _readnk(f.read())
+    else:
+        try:
+            with urllib.request.urlopen(nkurl+fname, timeout=10) as u:
+                text = u.read().decode('latin-1')
+            table = _readnk(text) # an error page is not cached
+        except (OSError, ValueError):
+            bundled = os.path.join(nkbundled, fname)
+            if not os.path.isfile(bundled):
+                raise
+            with open(bundled) as f:
+                text = f.read()
+            table = _readnk(text)
+        _savenk(cached, text)
+    with _nklock:
+        return _nktables.setdefault(material, table)
+
+def prefetch(materials, workers: int = 8):
+    """Load the index tables for many materials concurrently
+    
+    Parameters
+    ----------
+    materials : list of string
+        materials from base of .nk files on volta
+    workers : int
+        number of simultaneous downloads
+        
+    Returns
+    -------
+    list of Index, one for each material
+    
+    Example
+    -------
+    >>> alf3, al, sio2, si = prefetch(['AlF3', 'Al', 'SiO2', 'Si'])
+    """
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        list(ex.map(nkTable, materials))
+    return [Index(m) for m in materials]
+
+def _ppcoef(lam, ndx, kind):
+    """Piecewise cubic coefficients, highest power first, for a complex
+    index table"""
+    if kind=='linear':
+        c = np.zeros((4, lam.size-1), dtype=complex)
+        c[2] = np.diff(ndx)/np.diff(lam)
+        c[3] = ndx[:-1]
+        return c
+    if kind=='cubic':
+        interp = intp.CubicSpline
+    elif kind=='pchip':
+        interp = intp.PchipInterpolator
+    else:
+        raise ValueError("unknown interpolation kind '"+str(kind)+"'")
+    return interp(lam, ndx.real).c+1j*interp(lam, ndx.imag).c
+
+def _ppcheck(material, lam, wavelength):
+    """raise a ValueError if wavelength is outside of the table"""
+    if np.size(wavelength)>0 and (np.min(wavelength)<lam[0] or
+                                  np.max(wavelength)>lam[-1]):
+        raise ValueError("wavelength outside of the "+material+
+                         " table, "+str(lam[0])+" to "+str(lam[-1])+" nm")
+
+class Polarization:
+    """ Polarization of a beamline as a function of photon energy
+    
+    The fraction of s polarization is interpolated in log energy with
+    piecewise polynomial coefficients computed once, so it can be
+    evaluated for whole arrays of wavelengths.
+    
+    Constructor Parameters
+    ----------------------
+    table : np.array
+        (N, 2) photon energy in eV and degree of s polarization
+        P = (Is-Ip)/(Is+Ip) at that energy
+    name : string
+        name of the profile, for polarization()
+    kind : string
+        interpolation kernel: 'cubic' (spline), 'pchip' or 'linear'
+    outside : float
+        fraction of s polarization outside of the table. If None, a
+        ValueError is raised for wavelengths outside of the table.
+    
+    Attributes
+    ----------
+    ev : np.array
+        energies of the table in eV
+    degree : np.array
+        degree of polarization at each energy
+    coef : np.array
+        (4, N-1) polynomial coefficients of the fraction of s
+        polarization in log10(eV), highest power first
+        
+    Example
+    -------
+    >>> bl = Polarization([[50, 0.9], [100, 0.85], [200, 0.8],
+    ...                    [400, 0.7]], 'BL6.3.2', outside=1.0)
+    >>> addPolarization(bl)
+    >>> s = refl.Reflectance(runs, i0, dark, polarization='BL6.3.2')
+    """
+    def __init__(self, table, name: str = '', kind: str = 'cubic',
+                 outside: float = None):
+        table = np.asarray(table, dtype=float)
+        table = table[np.argsort(table[:,0])]
+        self.name = name
+        self.kind = kind
+        self.outside = outside
+        self.ev = table[:,0]
+        self.degree = table[:,1]
+        self._logev = np.log10(self.ev)
+        self.coef = _ppcoef(self._logev, (self.degree+1)/2+0j, kind).real
+        self._x0 = self._logev.tolist()
+        self._c = self.coef.T.tolist()
+    def at(self, lam, outside: float = None):
+        """fraction of s polarization at the wavelengths lam in nm. If
+        given, outside replaces the value outside of the table."""
+        if outside is None:
+            outside = self.outside
+        if np.ndim(lam)==0:
+            return self._scalar(float(lam), outside)
+        x = np.log10(1239.8/np.asarray(lam, dtype=float))
+        x0 = self._logev
+        inside = (x>=x0[0]) & (x<=x0[-1])
+        if outside is None and not np.all(inside):
+            self._outside()
+        i = np.clip(np.searchsorted(x0, x, 'right')-1, 0, x0.size-2)
+        d = x-x0[i]
+        c = self.coef
+        fr = ((c[0,i]*d+c[1,i])*d+c[2,i])*d+c[3,i]
+        if outside is not None:
+            fr = np.where(inside, fr, outside)
+        return fr
+    def _scalar(self, lam, outside):
+        """at for one wavelength, in plain floats (much faster than
+        arrays of one element)"""
+        x = math.log10(1239.8/lam)
+        x0 = self._x0
+        if not x0[0]<=x<=x0[-1]:
+            if outside is None:
+                self._outside()
+            return outside
+        i = min(bisect.bisect_right(x0, x)-1, len(x0)-2)
+        d = x-x0[i]
+        c0, c1, c2, c3 = self._c[i]
+        return np.float64(((c0*d+c1)*d+c2)*d+c3)
+    def _outside(self):
+        raise ValueError("wavelength outside of the "+self.name+
+                         " polarization table, "+
+                         str(round(1239.8/self.ev[-1], 3))+" to "+
+                         str(round(1239.8/self.ev[0], 3))+" nm")
+
+# named polarization profiles; the ALS table is the default
+polarizations = {}
+defaultPolarization = 'ALS'
+
+def addPolarization(profile: Polarization):
+    """register a Polarization under its name"""
+    polarizations[profile.name] = profile
+
+def readPolarization(filename: str, name: str = None, kind: str = 'cubic',
+                     outside: float = None):
+    """
+    Read a polarization table and register it
+    
+    Parameters
+    ----------
+    filename : string
+        text file with columns of photon energy in eV and degree of
+        s polarization; lines starting with # are comments
+    name : string
+        name of the profile, by default the base of the file name
+    kind, outside : as for Polarization
+    
+    Returns
+    -------
+    Polarization
+    """
+    if name is None:
+        name = os.path.splitext(os.path.basename(filename))[0]
+    profile = Polarization(np.loadtxt(filename, ndmin=2), name, kind,
+                           outside)
+    addPolarization(profile)
+    return profile
+
+def polarization(profile=None):
+    """the Polarization named profile (or profile itself if it is a
+    Polarization), or the default profile if profile is None"""
+    if isinstance(profile, Polarization):
+        return profile
+    if profile is None:
+        profile = defaultPolarization
+    try:
+        return polarizations[profile]
+    except KeyError:
+        raise ValueError("unknown polarization profile '"+str(profile)+
+                         "'") from None
+
+addPolarization(Polarization(ipts, 'ALS'))
+
+def fracs(lam, profile=None):
     """fraction of s poplarization at the ALS
     
     Parameters
     ----------
-    lam : number
+    lam : number or np.array
         wavelength in nm
+    profile : string or Polarization
+        beamline polarization profile, by default the ALS table
         
     Returns
     -------
@@ -221,11 +871,20 @@ def fracs(lam):
     >>> fracs(25.1)
     0.9272135287221943
     """
-    ev=np.log10(1239.8/lam)
-    return (frfunc(ev)+1)/2
+    return polarization(profile).at(lam)
+
+def _sfracs(lam, profile=None):
+    """fracs, with light outside of the table taken as s polarized"""
+    return polarization(profile).at(lam, 1.0)
 
-import pandas
-from scipy.interpolate import interp1d
+def _fractions(fractions, lam, outside: float = None):
+    """fraction of s polarization given as a number, or as a profile or
+    its name, with 0 meaning the default profile"""
+    if isinstance(fractions, (str, Polarization)):
+        return polarization(fractions).at(lam, outside)
+    if np.ndim(fractions)==0 and fractions==0:
+        return polarization().at(lam, outside)
+    return fractions
 
 class Index:
     """ Index of refraction from volta
@@ -233,7 +892,23 @@ class Index:
     Constructor Parameters
     ----------------------
     material : string
-        material from base of .nk file on volta
+        material from base of .nk file on volta. The table is
+        only read once per process (see nkTable).
+    kind : string
+        interpolation kernel: 'cubic' (spline), 'pchip' (monotone
+        piecewise cubic Hermite) or 'linear'
+    lambda_min, lambda_max : float
+        only the part of the table between these wavelengths in nm
+        is used
+    
+    Attributes
+    ----------
+    lam : np.array
+        tabulated wavelengths in nm
+    ndx : np.array
+        tabulated complex index
+    coef : np.array
+        precomputed (4, lam.size-1) piecewise polynomial coefficients
     
     Method
     ------
@@ -245,16 +920,440 @@ class Index:
     alndx=Index('Al')
     lam=np.linspace(10,400,200)
     ndx=alndx.at(lam)
+    al2o3=Index('Al2O3', 'pchip', 35, 50)
     """
-    def __init__(self, material):
-        df=pandas.read_table("http://volta.byu.edu/nk/"+material+".nk",
-                           comment=';',delim_whitespace=True)
-        val=df.values
-        lam=val[:,0]/10
-        ndx=val[:,1]+val[:,2]*1j
-        self.at=interp1d(lam,ndx,'cubic')
+    def __init__(self, material, kind: str = 'cubic',
+                 lambda_min: float = 0, lambda_max: float = np.inf):
+        lam, ndx = nkTable(material)
+        keep = (lam>=lambda_min) & (lam<=lambda_max)
+        self.material = material
+        self.kind = kind
+        self.lam = lam[keep]
+        self.ndx = ndx[keep]
+        self.coef = _ppcoef(self.lam, self.ndx, kind)
+    def at(self, wavelength):
+        lam = np.asarray(wavelength, dtype=float)
+        _ppcheck(self.material, self.lam, lam)
+        i = np.clip(np.searchsorted(self.lam, lam, 'right')-1,
+                    0, self.lam.size-2)
+        d = lam-self.lam[i]
+        c = self.coef
+        return ((c[0,i]*d+c[1,i])*d+c[2,i])*d+c[3,i]
 
-from csv import reader
+class MaterialSet:
+    """ Indices of refraction of all of the layers in a stack
+    
+    Constructor Parameters
+    ----------------------
+    materials : list of Index, string or number
+        material of each layer starting with the incident layer.
+        Strings are loaded as Index objects. A number (e.g. 1 for
+        vacuum) is used at every wavelength.
+    kind, lambda_min, lambda_max :
+        passed on to Index for materials given by name
+        
+    Method
+    ------
+    at(wavelength) : returns the index of every layer at the given
+        wavelengths in nm with the layers along the last axis, ready
+        to hand to Parratt. The coefficients of all materials are
+        evaluated together in one pass.
+        
+    Example
+    -------
+    mats = MaterialSet([1, 'AlF3', 'Al', 'SiO2', 'Si'])
+    n = mats.at(np.linspace(10, 40, 3000))    # shape (3000, 5)
+    """
+    def __init__(self, materials, kind: str = 'cubic',
+                 lambda_min: float = 0, lambda_max: float = np.inf):
+        self.materials = [Index(m, kind, lambda_min, lambda_max)
+                          if isinstance(m, str) else m for m in materials]
+        self.fixed = np.array([0 if isinstance(m, Index) else m
+                               for m in self.materials], dtype=complex)
+        self.tabulated = [i for i, m in enumerate(self.materials)
+                          if isinstance(m, Index)]
+        idx = [self.materials[i] for i in self.tabulated]
+        self._idx = idx
+        self._off = np.cumsum([0]+[m.lam.size-1 for m in idx])[:-1]
+        if idx:
+            self._left = np.concatenate([m.lam[:-1] for m in idx])
+            self._coef = np.concatenate([m.coef for m in idx], axis=1)
+    def at(self, wavelength):
+        lam = np.asarray(wavelength, dtype=float)
+        n = np.empty(lam.shape+(len(self.materials),), dtype=complex)
+        n[...] = self.fixed
+        if not self._idx:
+            return n
+        for m in self._idx:
+            _ppcheck(m.material, m.lam, lam)
+        i = np.stack([np.clip(np.searchsorted(m.lam, lam, 'right')-1,
+                              0, m.lam.size-2)+off
+                      for m, off in zip(self._idx, self._off)], axis=-1)
+        d = lam[...,np.newaxis]-self._left[i]
+        c = self._coef
+        n[...,self.tabulated] = ((c[0,i]*d+c[1,i])*d+c[2,i])*d+c[3,i]
+        return n
+
+def gridR(materials, x, thetad, lam, fractions=0, sigma=0.0):
+    """Reflectance map of a multilayer mirror over wavelength and angle
+    
+    Parameters
+    ----------
+    materials : MaterialSet or list of Index, string or number
+        material of each layer starting with the incident layer.
+        An Index is interpolated at all of the wavelengths at once;
+        a number (e.g. 1 for vacuum) is used at every wavelength.
+    x : np.array of layer thicknesses, as in Parratt
+    thetad : np.array
+        incident angles in degrees
+    lam : np.array
+        wavelengths in nanometers
+    fractions : number or np.array
+        fraction of light with s polarization, or the name of a
+        polarization profile. If zero, this is calculated for all
+        wavelengths with the default profile. Wavelengths outside of
+        its table are taken to be s polarized, as in matR.
+    sigma : array of number
+        interface roughness in nm
+        
+    Returns
+    -------
+    ref : np.array
+        reflectance with shape (lam.size, thetad.size)
+        
+    Example
+    -------
+    >>> wl = np.linspace(50, 200, 200)
+    >>> th = np.linspace(1, 89, 500)
+    >>> mats = [1, Index('Al2O3'), Index('Al')]
+    >>> r = gridR(mats, np.array([0, 3, 0]), th, wl)
+    >>> r.shape
+    (200, 500)
+    """
+    lam = np.atleast_1d(np.asarray(lam, dtype=float))
+    thetad = np.atleast_1d(np.asarray(thetad, dtype=float))
+    if not isinstance(materials, MaterialSet):
+        materials = MaterialSet(materials)
+    n = materials.at(lam)
+    fractions = _fractions(fractions, lam, 1.0)
+    fractions = np.broadcast_to(fractions, lam.shape)[:,np.newaxis]
+    return Parratt(n[:,np.newaxis,:], x, thetad[np.newaxis,:],
+                   lam[:,np.newaxis], fractions, sigma)
+
+class Free:
+    """ A fitted (free) parameter of a Stack
+    
+    Constructor Parameters
+    ----------------------
+    value : float
+        starting value
+    lower, upper : float
+        bounds for the fit
+        
+    Example
+    -------
+    Free(8, 0, 30)
+    """
+    def __init__(self, value: float, lower: float = -np.inf,
+                 upper: float = np.inf):
+        self.value = value
+        self.lower = lower
+        self.upper = upper
+
+class Layer:
+    """ One layer of a Stack
+    
+    Constructor Parameters
+    ----------------------
+    n : Index, string, number or Free
+        the material of the layer as an Index or the name of a .nk
+        file, or the real part of the index of refraction. A number
+        may be complex; a Free real part is fitted.
+    k : number or Free
+        imaginary part of the index if n is a number or Free
+    thickness : number or Free
+        thickness in nm. Should be 0 for the incident layer and the
+        substrate.
+    sigma : number or Free
+        roughness in nm of the interface on top of this layer. Ignored
+        for the incident layer.
+    name : string
+        appended to the names of the free parameters of the layer. By
+        default this is the layer number.
+        
+    Example
+    -------
+    Layer(Free(0.95, 0.8, 1.1), Free(0.025, 0, 0.2), Free(8, 0, 30), 1.0,
+          name='f')
+    """
+    def __init__(self, n=1, k=0, thickness=0, sigma=0, name: str = ''):
+        self.n = n
+        self.k = k
+        self.thickness = thickness
+        self.sigma = sigma
+        self.name = name
+
+def _value(p):
+    return p.value if isinstance(p, Free) else p
+
+class Stack:
+    """ A multilayer stack with fixed and free parameters, compiled to a
+    model function for curve_fit
+    
+    The index of every fixed layer is interpolated once when the stack
+    is built. Calling the stack writes the free parameters into
+    preallocated index, thickness and roughness arrays and evaluates
+    Parratt for all angles at once, restarting the recursion from the
+    deepest free layer through a ParrattCache. Because of these shared
+    buffers a Stack should not be called from several threads at once.
+    
+    Constructor Parameters
+    ----------------------
+    layers : list of Layer
+        the layers starting with the incident layer
+    lam : float
+        wavelength in nm
+    fractions : float, string or Polarization
+        fraction of s polarization, or the polarization profile to
+        calculate it from once. If zero, the default profile is used.
+        
+    Attributes
+    ----------
+    p0 : np.array
+        starting values of the free parameters
+    bounds : tuple of np.array
+        lower and upper bounds of the free parameters
+    names : list of string
+        names of the free parameters: kind ('n', 'k', 'x' or 'sigma')
+        followed by the layer name
+        
+    Methods
+    -------
+    stack(thetad, *p) : reflectance at the angles in thetad
+    jac(thetad, *p) : exact Jacobian, for the jac argument of curve_fit
+    residuals(p, thetad, rfl, sigma) : weighted residuals and
+    residual_jac(p, thetad, rfl, sigma) : their Jacobian, for
+        scipy.optimize.least_squares
+        
+    Example
+    -------
+    f = Stack([Layer(1),
+               Layer(Free(0.95, 0.8, 1.1), Free(0.025, 0, 0.2),
+                     Free(8, 0, 30), 1.0, name='f'),
+               Layer('Al', thickness=Free(26, 0, 60), name='a'),
+               Layer('Si3N4')], s18.wavelength)
+    popt, pcov = curve_fit(f, s18.ang, s18.rfl, f.p0, sigmaw,
+                           bounds=f.bounds, jac=f.jac)
+    """
+    def __init__(self, layers, lam: float, fractions=0):
+        self.layers = layers
+        self.lam = lam
+        self.fractions = _fractions(fractions, lam)
+        nl = len(layers)
+        self._n = np.empty(nl, dtype=complex)
+        self._x = np.zeros(nl)
+        self._sigma = np.zeros(nl-1)
+        self._cache = ParrattCache()
+        free = {'n': ([], []), 'k': ([], []), 'x': ([], []),
+                'sigma': ([], [])}
+        p0, lower, upper, names = [], [], [], []
+        def add(kind, where, p, layer):
+            free[kind][0].append(len(p0))
+            free[kind][1].append(where)
+            p0.append(p.value)
+            lower.append(p.lower)
+            upper.append(p.upper)
+            names.append(kind+(layer.name or str(i)))
+        for i, layer in enumerate(layers):
+            if isinstance(layer.n, (str, Index)):
+                ndx = Index(layer.n) if isinstance(layer.n, str) else layer.n
+                self._n[i] = ndx.at(lam)
+            else:
+                self._n[i] = _value(layer.n)+1j*_value(layer.k)
+                if isinstance(layer.n, Free):
+                    add('n', i, layer.n, layer)
+                if isinstance(layer.k, Free):
+                    add('k', i, layer.k, layer)
+            self._x[i] = _value(layer.thickness)
+            if isinstance(layer.thickness, Free):
+                add('x', i, layer.thickness, layer)
+            if i > 0:
+                self._sigma[i-1] = _value(layer.sigma)
+                if isinstance(layer.sigma, Free):
+                    add('sigma', i-1, layer.sigma, layer)
+        self._free = [(kind, np.array(free[kind][0], dtype=int),
+                       np.array(free[kind][1], dtype=int))
+                      for kind in ('n', 'k', 'x', 'sigma')]
+        self.p0 = np.array(p0, dtype=float)
+        self.bounds = (np.array(lower, dtype=float),
+                       np.array(upper, dtype=float))
+        self.names = names
+    def _set(self, p):
+        p = np.asarray(p, dtype=float)
+        (_, pn, ln), (_, pk, lk), (_, px, lx), (_, ps, ls) = self._free
+        self._n.real[ln] = p[pn]
+        self._n.imag[lk] = p[pk]
+        self._x[lx] = p[px]
+        self._sigma[ls] = p[ps]
+    def __call__(self, thetad, *p):
+        self._set(p)
+        return Parratt(self._n, self._x, thetad, self.lam, self.fractions,
+                       self._sigma, self._cache)
+    def jac(self, thetad, *p):
+        self._set(p)
+        d = ParrattJac(self._n, self._x, thetad, self.lam, self.fractions,
+                       self._sigma)[1:]
+        J = np.empty(np.shape(thetad)+(self.p0.size,))
+        for dd, (kind, pi, li) in zip(d, self._free):
+            J[...,pi] = dd[...,li]
+        return J
+    def residuals(self, p, thetad, rfl, sigma=1.0):
+        return (self(thetad, *p)-rfl)/sigma
+    def residual_jac(self, p, thetad, rfl, sigma=1.0):
+        return self.jac(thetad, *p)/np.asarray(sigma)[...,np.newaxis]
+
+class JointStack:
+    """ One multilayer stack fitted to spectra at several wavelengths
+    
+    Thicknesses and roughnesses are shared by all wavelengths, free
+    indices are fitted separately at each wavelength. The Jacobian is
+    block sparse: the residuals of one spectrum depend only on the
+    shared parameters and on the indices at its own wavelength, so
+    least_squares works in time proportional to the number of spectra.
+    
+    Constructor Parameters
+    ----------------------
+    layers : list of Layer
+        the layers starting with the incident layer, as for Stack.
+        Layers whose index is a material name are interpolated at each
+        wavelength.
+    spectra : list of Reflectance
+        the measured spectra, one per wavelength
+    sigma : list of np.array
+        uncertainty of each spectrum, or None for equal weights
+        
+    Attributes
+    ----------
+    stacks : list of Stack
+        the stack at each wavelength
+    p0 : np.array
+        starting values: the shared parameters followed by the free
+        indices of each wavelength in turn
+    bounds : tuple of np.array
+        lower and upper bounds of the parameters
+    names : list of string
+        names of the parameters; per wavelength names end in @ and the
+        wavelength
+    sparsity : scipy.sparse.csr_matrix
+        ones where the Jacobian can be nonzero
+        
+    Methods
+    -------
+    residuals(p) : weighted residuals of all spectra
+    jac(p) : their sparse Jacobian
+    fit(p0, exact) : least squares fit, returns the OptimizeResult
+    split(p) : parameters of each Stack
+        
+    Example
+    -------
+    layers = [Layer(1),
+              Layer(Free(0.95, 0.8, 1.1), Free(0.025, 0, 0.2),
+                    Free(8, 0, 30), Free(1.0, 0, 3), name='f'),
+              Layer('Al', thickness=26, name='a'),
+              Layer('Si3N4')]
+    joint = JointStack(layers, [s12, s15, s18])
+    res = joint.fit()
+    print(dict(zip(joint.names, res.x)))
+    """
+    def __init__(self, layers, spectra, sigma=None):
+        self.layers = layers
+        self.spectra = spectra
+        if sigma is None:
+            sigma = [1.0]*len(spectra)
+        self.sigma = sigma
+        self.stacks = [Stack(layers, r.wavelength, r.frs) for r in spectra]
+        first = self.stacks[0]
+        kinds = np.empty(first.p0.size, dtype=object)
+        for kind, pi, li in first._free:
+            kinds[pi] = kind
+        shared = np.flatnonzero((kinds=='x') | (kinds=='sigma'))
+        own = np.flatnonzero((kinds=='n') | (kinds=='k'))
+        nshared = shared.size
+        # columns of the joint parameter vector used by each stack
+        self.columns = []
+        p0, lower, upper = [first.p0[shared]], [first.bounds[0][shared]], \
+            [first.bounds[1][shared]]
+        self.names = [first.names[i] for i in shared]
+        for s, (stack, r) in enumerate(zip(self.stacks, spectra)):
+            cols = np.empty(first.p0.size, dtype=int)
+            cols[shared] = np.arange(nshared)
+            cols[own] = nshared+s*own.size+np.arange(own.size)
+            self.columns.append(cols)
+            p0.append(stack.p0[own])
+            lower.append(stack.bounds[0][own])
+            upper.append(stack.bounds[1][own])
+            self.names += [stack.names[i]+'@'+str(r.wavelength) for i in own]
+        self.p0 = np.concatenate(p0)
+        self.bounds = (np.concatenate(lower), np.concatenate(upper))
+        self.rows = np.cumsum([0]+[r.ang.size for r in spectra])
+        rows, cols = [], []
+        for s, c in enumerate(self.columns):
+            r = np.arange(self.rows[s], self.rows[s+1])
+            rows.append(np.repeat(r, c.size))
+            cols.append(np.tile(c, r.size))
+        self._rows = np.concatenate(rows)
+        self._cols = np.concatenate(cols)
+        self.sparsity = sparse.csr_matrix(
+            (np.ones(self._rows.size), (self._rows, self._cols)),
+            shape=(self.rows[-1], self.p0.size))
+    def split(self, p):
+        return [np.asarray(p)[c] for c in self.columns]
+    def residuals(self, p):
+        return np.concatenate(
+            [stack.residuals(ps, r.ang, r.rfl, sig) for stack, ps, r, sig
+             in zip(self.stacks, self.split(p), self.spectra, self.sigma)])
+    def jac(self, p):
+        blocks = [stack.residual_jac(ps, r.ang, r.rfl, sig).ravel()
+                  for stack, ps, r, sig
+                  in zip(self.stacks, self.split(p), self.spectra,
+                         self.sigma)]
+        return sparse.csr_matrix(
+            (np.concatenate(blocks), (self._rows, self._cols)),
+            shape=self.sparsity.shape)
+    def fit(self, p0=None, exact=True, **kwargs):
+        """
+        Fit all spectra at once with scipy.optimize.least_squares
+        
+        Parameters
+        ----------
+        p0 : np.array
+            starting parameters, self.p0 if None
+        exact : bool
+            use the exact Jacobian; otherwise it is estimated by finite
+            differences grouped with self.sparsity
+        kwargs :
+            passed on to least_squares
+        
+        Returns
+        -------
+        res : scipy.optimize.OptimizeResult
+            the result of least_squares
+        """
+        if p0 is None:
+            p0 = self.p0
+        if exact:
+            kwargs.setdefault('jac', self.jac)
+        else:
+            kwargs.setdefault('jac_sparsity', self.sparsity)
+        return least_squares(self.residuals, p0, bounds=self.bounds,
+                             tr_solver='lsmr', **kwargs)
+
+def _column(col):
+    """a column of strings as a float array if it is all numbers"""
+    try:
+        return col.astype(float)
+    except ValueError:
+        return col
 
 class Log:
     """ Information from the log file for an ALS run
@@ -276,32 +1375,31 @@ class Log:
     time: time of run
     gain: log_10 of the gain of the run
     wavelength: wavelength (assumed nm)
+    columns: every column of the log file, indexed by run number.
+        Columns with only numbers are float arrays, the rest
+        are arrays of strings.
+    table: the log file entries as a 2-D array of strings
     """
     def __init__(self, path:str = 'X:/ALSData/2018/Feb2018',
-                 prefix:str = 'Feb2018'):
+                 prefix:str = 'Feb2018', table: np.ndarray = None):
         self.path = path
-        self.filename = ['']
-        self.fullname = ['']
-        self.comment = ['']
-        self.date = ['']
-        self.time = ['']
-        self.gain = [0]
-        self.wavelength = [0]
-        mypath = path+'/'+prefix+'.log'
-        with open(mypath, newline='') as f:
-            f.readline(); # skip first header line
-            f.readline(); # skip second header line
-            rdr = reader(f, delimiter='\t')
-            for row in rdr:
-                self.filename.append(row[2]);
-                self.fullname.append(path+'/'+row[2])
-                self.comment.append(row[3])
-                self.date.append(row[4])
-                self.time.append(row[5])
-                self.gain.append(float(row[8]))
-                self.wavelength.append(float(row[26]))
-        self.gain = np.array(self.gain)
-        self.wavelength = np.array(self.wavelength)
+        if table is None:
+            mypath = path+'/'+prefix+'.log'
+            table = np.loadtxt(mypath, dtype=str, delimiter='\t',
+                               comments=None, skiprows=2, ndmin=2)
+        self.table = table
+        # the table is converted a column at a time; row 0 is padding
+        # so runs are numbered from 1
+        self.columns = [_column(table[:,j]) for j in range(table.shape[1])]
+        self.columns = [np.concatenate(([0 if c.dtype.kind=='f' else ''],
+                                        c)) for c in self.columns]
+        self.filename = ['']+table[:,2].tolist()
+        self.fullname = ['']+[path+'/'+fn for fn in self.filename[1:]]
+        self.comment = ['']+table[:,3].tolist()
+        self.date = ['']+table[:,4].tolist()
+        self.time = ['']+table[:,5].tolist()
+        self.gain = self.columns[8].astype(float)
+        self.wavelength = self.columns[26].astype(float)
 
 class Run:
     """ The parsed data from a raw data file
@@ -312,6 +1410,9 @@ class Run:
         log object with filename, gaine, wavelength, etc.
     run : int
         run number
+    data : np.array of float
+        if given, the columns of the run (one per row) are taken from
+        this array instead of being read from the data file
         
     Attributes
     ----------
@@ -323,6 +1424,10 @@ class Run:
         m3 mirror reading
     beam : np.array of float
         beam current
+    data : np.array of float
+        all of the columns in the file, one per row
+    run : int
+        run number
     wavelength : float
         wavelength in nm (usually)
     comment : string
@@ -331,23 +1436,14 @@ class Run:
         log10 of gain for run
     
     """
-    def __init__(self, log: Log, run: int):
-        self.var = []
-        self.diode = []
-        self.m3 = []
-        self.beam = []
-        with open(log.fullname[run]) as f:
-            f.readline();
-            rdr = reader(f, delimiter='\t')
-            for row in rdr:
-                self.var.append(float(row[0]))
-                self.diode.append(float(row[1]))
-                self.m3.append(float(row[2]))
-                self.beam.append(float(row[3]))
-        self.var = np.array(self.var)
-        self.diode = np.array(self.diode)
-        self.m3 = np.array(self.m3)
-        self.beam = np.array(self.beam)
+    def __init__(self, log: Log, run: int, data: np.ndarray = None):
+        if data is None:
+            data = np.ascontiguousarray(
+                np.loadtxt(log.fullname[run], delimiter='\t', skiprows=1,
+                           ndmin=2).T)
+        self.data = data
+        self.run = run
+        self.var, self.diode, self.m3, self.beam = self.data[:4]
         self.wavelength = log.wavelength[run]
         self.comment = log.comment[run]
         self.gain = log.gain[run]
@@ -357,6 +1453,64 @@ class Run:
         plt.title(self.comment)
         plt.show()
 
+class RunTail:
+    """ A run file that is still being written
+    
+    Each call to read returns the rows added to the file since the last
+    call as a Run. A line is only read once it is complete, so the file
+    can be read while the instrument appends to it.
+    
+    Constructor Parameters
+    ----------------------
+    log : Log
+        log object with the file name, gain, wavelength, etc.
+    run : int
+        run number
+        
+    Attributes
+    ----------
+    npts : int
+        number of rows read so far
+        
+    Example
+    -------
+    tail = RunTail(log, 122)
+    spectrum = Reflectance()
+    while scanning:
+        new = tail.read()
+        if new is not None:
+            spectrum.extend(Reflectance((new,), runs[97], dark))
+    """
+    def __init__(self, log: Log, run: int):
+        self.log = log
+        self.run = run
+        self.npts = 0
+        self._pos = 0
+        self._header = True
+        self._partial = b''
+    def read(self):
+        """the new complete rows as a Run, or None if there are none"""
+        try:
+            with open(self.log.fullname[self.run], 'rb') as f:
+                f.seek(self._pos)
+                chunk = f.read()
+        except FileNotFoundError:
+            return None
+        self._pos += len(chunk)
+        lines = (self._partial+chunk).split(b'\n')
+        self._partial = lines.pop()
+        if self._header and lines:
+            lines.pop(0)
+            self._header = False
+        lines = [line for line in lines if line.strip()]
+        if not lines:
+            return None
+        data = np.ascontiguousarray(
+            np.loadtxt([line.decode() for line in lines], delimiter='\t',
+                       ndmin=2).T)
+        self.npts += data.shape[1]
+        return Run(self.log, self.run, data)
+
 class Runs:
     """ A cached collection of Run objects
     
@@ -368,29 +1522,330 @@ class Runs:
         as the log file.
     prefix : the prefix for the data files in the runs. A full
         data file name will be <prefix><run number>.dat
+    archive : tuple
+        (data, offsets) from a beamtime archive, see openArchive.
+        If given, runs are views into data instead of being read
+        from the data files.
+    maxbytes : int
+        budget for the cached run data in bytes. When it is exceeded,
+        the least recently used runs are dropped. Zero means no limit.
+    workers : int
+        number of threads used by prefetch
+    dropped : dict
+        runs of the archive whose data file could not be read, with
+        the error. Asking for one of them raises ValueError.
         
     Method
     ------
     [] : overloaded index operator returning a Run object. The
         first time a run is referenced, the information is read
         from the raw data. Subsequent accesses used cached data
-        from a dictionary.
+        from a dictionary. It is safe to use from several threads;
+        a run being loaded by one thread is not loaded again by
+        another.
+    prefetch(run_numbers) : start loading runs in the background
         
     Example
     -------
     log = Log('X:/ALSData/2018/Feb2018','Feb2018')
-    runs = Runs(log)
+    runs = Runs(log, maxbytes=2**30)
     run21 = runs[21]
+    runs.prefetch(range(22, 30))
     """
-    def __init__(self, log:Log):
+    def __init__(self, log:Log, archive: tuple = None, maxbytes: int = 0,
+                 workers: int = 4, dropped: dict = None):
         self.log = log
-        self.rn = {}
+        self.archive = archive
+        self.dropped = dropped or {}
+        self.maxbytes = maxbytes
+        self.workers = workers
+        self.nbytes = 0
+        self.rn = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+        self._pool = None
+    def _load(self, index):
+        if self.archive is None:
+            return Run(self.log, index)
+        if index in self.dropped:
+            raise ValueError('run '+str(index)+' is not in the archive: '+
+                             self.dropped[index])
+        data, offsets = self.archive
+        return Run(self.log, index, data[:,offsets[index]:offsets[index+1]])
     def __getitem__(self,index):
         sndx = str(index)
-        if sndx not in self.rn:
-            self.rn[sndx] = Run(self.log, index)
-        return self.rn[sndx]
+        with self._lock:
+            if sndx in self.rn:
+                self.rn.move_to_end(sndx)
+                return self.rn[sndx]
+            loading = self._loading.get(sndx)
+            if loading is None:
+                loading = self._loading[sndx] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return loading.result()
+        try:
+            run = self._load(index)
+        except BaseException as e:
+            with self._lock:
+                del self._loading[sndx]
+            loading.set_exception(e)
+            raise
+        with self._lock:
+            del self._loading[sndx]
+            self.rn[sndx] = run
+            self.nbytes += run.data.nbytes
+            while self.maxbytes and self.nbytes > self.maxbytes and \
+                    len(self.rn) > 1:
+                self.nbytes -= self.rn.popitem(last=False)[1].data.nbytes
+        loading.set_result(run)
+        return run
+    def prefetch(self, run_numbers):
+        """Load runs on a thread pool while the caller keeps working
+        
+        Parameters
+        ----------
+        run_numbers : iterable of int
+            runs to load
+            
+        Returns
+        -------
+        list of concurrent.futures.Future, one for each run
+        """
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers)
+        return [self._pool.submit(self.__getitem__, run)
+                for run in run_numbers]
+
+_archmagic = b'REFLARCH'
+_archalign = 64
+
+def writeArchive(log: Log, filename: str):
+    """Pack the log and the var, diode, m3 and beam columns of every run
+    of a beamtime into a single binary file
+    
+    The file holds a short header, the log table, an index with the
+    offset of each run and the run columns concatenated, so that
+    openArchive can memory map it. Each data file is parsed once and
+    its columns are kept in a scratch file next to the archive until
+    the index is known, so only one run is in memory at a time. Runs
+    whose data file can't be read are stored with no points, listed
+    with their error in the header and reported with a warning; Runs
+    from openArchive raise ValueError for them.
+    
+    Parameters
+    ----------
+    log : Log
+        log for the beamtime
+    filename : string
+        name of the archive file to write
+        
+    Returns
+    -------
+    dropped : dict
+        error message of each run that could not be read
+        
+    Example
+    -------
+    >>> writeArchive(Log('X:/ALSData/2018/Feb2018','Feb2018'), 'Feb2018.bin')
+    """
+    nruns = len(log.filename)-1
+    counts = np.zeros(nruns+1, dtype=np.int64)
+    dropped = {}
+    with tempfile.TemporaryFile(
+            dir=os.path.dirname(os.path.abspath(filename))) as scratch:
+        for run in range(1, nruns+1):
+            try:
+                data = np.ascontiguousarray(Run(log, run).data[:4],
+                                            dtype=np.float64)
+            except (OSError, ValueError) as e:
+                dropped[run] = type(e).__name__+': '+str(e)
+                continue
+            scratch.write(data.tobytes())
+            counts[run] = data.shape[1]
+        if dropped:
+            warnings.warn('runs '+', '.join(str(run) for run in dropped)+
+                          ' could not be read and are archived with no '
+                          'points')
+        offsets = np.cumsum(np.concatenate(([0], counts))).astype(np.int64)
+        header = {'version': 1, 'path': log.path,
+                  'table': log.table.tolist(),
+                  'dropped': {str(run): e for run, e in dropped.items()}}
+        hbytes = json.dumps(header).encode('utf-8')
+        start = len(_archmagic)+8+len(hbytes)
+        start += -start % _archalign
+        with open(filename, 'wb') as f:
+            f.write(_archmagic)
+            f.write(np.int64(len(hbytes)).tobytes())
+            f.write(hbytes)
+            f.write(b'\0'*(start-f.tell()))
+            f.write(offsets.tobytes())
+            f.write(b'\0'*(-f.tell() % _archalign))
+            # one row per column so each run column is contiguous
+            for j in range(4):
+                for run in range(1, nruns+1):
+                    scratch.seek(8*(4*offsets[run]+j*counts[run]))
+                    f.write(scratch.read(8*counts[run]))
+    return dropped
+
+def openArchive(filename: str):
+    """Open a beamtime archive written by writeArchive
+    
+    The run data are memory mapped, so opening is fast no matter how big
+    the archive is and runs are only paged in when they are used.
     
+    Parameters
+    ----------
+    filename : string
+        name of the archive file
+        
+    Returns
+    -------
+    Runs with the log of the beamtime as Runs.log
+    
+    Example
+    -------
+    >>> runs = openArchive('Feb2018.bin')
+    >>> run21 = runs[21]
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(_archmagic))!=_archmagic:
+            raise ValueError(filename+" is not a beamtime archive")
+        hlen = int(np.frombuffer(f.read(8), dtype=np.int64)[0])
+        header = json.loads(f.read(hlen).decode('utf-8'))
+    start = len(_archmagic)+8+hlen
+    start += -start % _archalign
+    table = np.array(header['table'], dtype=str).reshape(
+        len(header['table']), -1)
+    log = Log(header['path'], table=table)
+    nruns = len(log.filename)-1
+    offsets = np.memmap(filename, dtype=np.int64, mode='r', offset=start,
+                        shape=(nruns+2,))
+    start += offsets.nbytes
+    start += -start % _archalign
+    npts = int(offsets[-1])
+    data = np.memmap(filename, dtype=np.float64, mode='r', offset=start,
+                     shape=(4, npts))
+    dropped = {int(run): e for run, e in header.get('dropped', {}).items()}
+    return Runs(log, (data, offsets), dropped=dropped)
+    
+class Calibration:
+    """ Dark current, direct beam and beam normalization for a beamtime
+    
+    Constructor Parameters
+    ----------------------
+    runs : Runs
+        runs of the beamtime
+    darkruns : iterable of int
+        dark current runs. The dark current for a gain is the mean
+        diode reading of all dark runs with that gain.
+    norm : string
+        'none', 'beam' to divide the signal by the beam current or
+        'm3' to divide it by the M3 mirror current
+        
+    Attributes
+    ----------
+    gains : np.array of float
+        gains with a dark current
+    darks : np.array of float
+        dark current for each gain
+        
+    Methods
+    -------
+    dark(gain) : dark current for one or many gains
+    signal(run) : normalized signal of a Run
+    signals(run_numbers) : normalized signal of many runs in one pass
+    i0(i0run, wavelength) : normalized direct beam of a Run at a
+        wavelength, cached
+        
+    Example
+    -------
+    log = Log()
+    runs = Runs(log)
+    cal = Calibration(runs, (101, 98, 99, 100))
+    s18a = Reflectance((runs[119],), runs[97], cal)
+    """
+    def __init__(self, runs: Runs, darkruns, norm: str = 'none'):
+        if norm not in ('none', 'beam', 'm3'):
+            raise ValueError("unknown normalization '"+str(norm)+"'")
+        self.runs = runs
+        self.norm = norm
+        gain = np.array([runs.log.gain[r] for r in darkruns])
+        mean = np.array([np.mean(runs[r].diode) for r in darkruns])
+        self.gains, inv = np.unique(gain, return_inverse=True)
+        self.darks = (np.bincount(inv, mean)/np.bincount(inv))
+        self._i0 = {}
+        self._lock = threading.Lock()
+    def _dark(self, gain):
+        """dark current for each gain, nan where there is none"""
+        gain = np.asarray(gain, dtype=float)
+        if self.gains.size==0:
+            return np.full(gain.shape, np.nan)
+        i = np.clip(np.searchsorted(self.gains, gain), 0, self.gains.size-1)
+        return np.where(self.gains[i]==gain, self.darks[i], np.nan)
+    def dark(self, gain):
+        d = self._dark(gain)
+        if np.any(np.isnan(d)):
+            raise ValueError("no dark current run for gain "+
+                             str(np.asarray(gain)[np.isnan(d)].flat[0]))
+        return d
+    def _signal(self, diode, m3, beam, gain, dark):
+        s = (diode-dark)/10**gain
+        if self.norm=='beam':
+            s = s/beam
+        elif self.norm=='m3':
+            s = s/m3
+        return s
+    def signal(self, run: Run):
+        return self._signal(run.diode, run.m3, run.beam, run.gain,
+                            self.dark(run.gain))
+    def signals(self, run_numbers=None):
+        """Normalized signal for many runs at once
+        
+        Parameters
+        ----------
+        run_numbers : iterable of int
+            runs to normalize. By default, every run in the beamtime;
+            this needs Runs opened from an archive.
+            
+        Returns
+        -------
+        tuple with
+        signal : np.array
+            normalized signal of all the runs, concatenated. Points of
+            runs with a gain that has no dark run are nan.
+        offsets : np.array of int
+            run i is signal[offsets[i]:offsets[i+1]]
+        """
+        log = self.runs.log
+        if run_numbers is None:
+            if self.runs.archive is None:
+                raise ValueError('the signal of every run needs Runs '
+                                 'opened from an archive')
+            data, offsets = self.runs.archive
+            gain = log.gain
+        else:
+            runs = [self.runs[r] for r in run_numbers]
+            data = np.concatenate([r.data[:4] for r in runs], axis=1)
+            offsets = np.cumsum([0]+[r.var.size for r in runs])
+            gain = np.array([r.gain for r in runs])
+        gain = np.repeat(gain, np.diff(offsets))
+        return (self._signal(data[1], data[2], data[3], gain,
+                             self._dark(gain)), offsets)
+    def i0(self, i0run: Run, wavelength: float):
+        """normalized direct beam of i0run interpolated at wavelength"""
+        key = (i0run.run, wavelength)
+        with self._lock:
+            if key in self._i0:
+                return self._i0[key]
+        itrp = intp.interp1d(i0run.var, self.signal(i0run), 'cubic')
+        r0 = float(itrp(wavelength))
+        with self._lock:
+            return self._i0.setdefault(key, r0)
+
 class Reflectance:
     """ Reflectance as a function of incident angle
     
@@ -400,8 +1855,11 @@ class Reflectance:
         runs with the reflected data
     i0run : Run
         run with the direct beam data
-    dark : tuple of float
-        dark current for gains 7, 8, 9, and 10
+    dark : tuple of float or Calibration
+        dark current for gains 7, 8, 9, and 10, or the Calibration
+        of the beamtime
+    polarization : string or Polarization
+        polarization profile of the beamline, by default the ALS
         
     Attributes
     ----------
@@ -416,51 +1874,82 @@ class Reflectance:
         return a new Spectrum with theta between thmin and thmax
     +
         overloaded addition operator to combine spectra
+    extend(other : Reflectance)
+        add the points of other to this spectrum
     """
-    def __init__(self, iruns: tuple=(), i0run: Run=0, dark: tuple=()):
+    def __init__(self, iruns: tuple=(), i0run: Run=0, dark: tuple=(),
+                 polarization=None):
         if len(iruns)==0:
             self.wavelength = 0.0
             self.frs = 0.0
             self.ang = np.array([])
             self.rfl = np.array([])
         else:            
-            ang = np.array([])
-            rfl = np.array([])
             self.wavelength = iruns[0].wavelength
-            self.frs = fracs(self.wavelength)
-            itrp = intp.interp1d(i0run.var, i0run.diode, 'cubic')
-            ir = itrp(self.wavelength)
-            r0 = (ir-dark[int(i0run.gain)-7])/10**i0run.gain
+            self.frs = fracs(self.wavelength, polarization)
+            if isinstance(dark, Calibration):
+                r0 = dark.i0(i0run, self.wavelength)
+                signal = dark.signal
+            else:
+                itrp = intp.interp1d(i0run.var, i0run.diode, 'cubic')
+                ir = itrp(self.wavelength)
+                r0 = (ir-dark[int(i0run.gain)-7])/10**i0run.gain
+                signal = lambda run: ((run.diode-dark[int(run.gain)-7])/
+                                      10**run.gain)
+            npts = sum(run.var.size for run in iruns)
+            ang = np.empty(npts)
+            rfl = np.empty(npts)
+            i = 0
             for run in iruns:
-                ang = np.append(ang, run.var)
-                rf = (run.diode-dark[int(run.gain)-7])/10**run.gain
-                rfl = np.append(rfl, rf/r0)
-            ad = np.array([ang, rfl]).T
-            ad = np.array(sorted(ad, key=lambda m:m[0]))
-            self.ang = ad[:,0]
-            self.rfl = ad[:,1]
-        
-    def __add__(self, other):
+                j = i+run.var.size
+                ang[i:j] = run.var
+                rfl[i:j] = signal(run)/r0
+                i = j
+            order = np.argsort(ang, kind='stable')
+            self.ang = ang[order]
+            self.rfl = rfl[order]
+    
+    def _like(self, ang, rfl):
+        """new Reflectance with these points and our wavelength"""
         rp = Reflectance()
-        ang = np.concatenate((self.ang, other.ang),axis=0)
-        rfl = np.concatenate((self.rfl, other.rfl),axis=0)
-        ad = np.array([ang, rfl]).T
-        ad = np.array(sorted(ad, key=lambda m:m[0]))
-        rp.ang = ad[:,0]
-        rp.rfl = ad[:,1]
+        rp.ang = ang
+        rp.rfl = rfl
         rp.wavelength = self.wavelength
         rp.frs = self.frs
         return rp
+        
+    def __add__(self, other):
+        # both spectra are sorted, so they are merged in linear time.
+        # Points of other go after points of self at the same angle.
+        pos = (np.searchsorted(self.ang, other.ang, 'right')+
+               np.arange(other.ang.size))
+        npts = self.ang.size+other.ang.size
+        mine = np.ones(npts, dtype=bool)
+        mine[pos] = False
+        ang = np.empty(npts)
+        rfl = np.empty(npts)
+        ang[pos] = other.ang
+        ang[mine] = self.ang
+        rfl[pos] = other.rfl
+        rfl[mine] = self.rfl
+        return self._like(ang, rfl)
+    
+    def extend(self, other):
+        """ merge the points of other into this spectrum in place, for
+        a spectrum that grows while its runs are being measured"""
+        if self.ang.size==0:
+            self.wavelength = other.wavelength
+            self.frs = other.frs
+        merged = self+other
+        self.ang = merged.ang
+        self.rfl = merged.rfl
     
     def filter(self, minang: float=0, maxang: float = 90):
-        rp = Reflectance()
-        ad = np.array([self.ang, self.rfl]).T
-        ad = np.array([x for x in ad if x[0]>=minang and x[0]<=maxang])
-        rp.ang = ad[:,0]
-        rp.rfl = ad[:,1]
-        rp.wavelength = self.wavelength
-        rp.frs = self.frs        
-        return rp
+        """ return the points with minang <= angle <= maxang. The
+        arrays of the new Reflectance are views into this one."""
+        lo = np.searchsorted(self.ang, minang, 'left')
+        hi = np.searchsorted(self.ang, maxang, 'right')
+        return self._like(self.ang[lo:hi], self.rfl[lo:hi])
     
     def plot(self):
         """ plot this reflectance data on a semilog plot with
@@ -470,4 +1959,149 @@ class Reflectance:
         plt.title('Wavelength = '+str(round(self.wavelength,3))+" nm")
         plt.xlabel('grazing angle, degrees')
         plt.ylabel('reflectance')
-        plt.show()
\ No newline at end of file
+        plt.show()
+
+_instrument = None
+
+class Instrument:
+    """ Counts and times of the refl hot paths
+    
+    While an Instrument is active (in a with statement) the functions
+    Parratt, ParrattJac, matR, gridR, fracs and _fractions (the lookup
+    of the polarization in Parratt and matR) and the methods
+    Index.at, MaterialSet.at, Stack.__call__ and Stack.jac are replaced
+    by wrappers that count and time every call. On exit the originals
+    are put back, so when no Instrument is active there is no cost at
+    all. Times are inclusive: the time of Parratt includes the time of
+    fracs when Parratt calls it. Functions imported by name before the
+    with statement (from refl import Parratt) are not wrapped.
+    
+    Constructor Parameters
+    ----------------------
+    trace : bool
+        keep every call in trace, not just the totals
+        
+    Attributes
+    ----------
+    calls : dict
+        number of calls of each stage
+    seconds : dict
+        total time in each stage
+    fits : list of dict
+        one entry for each call of the curve_fit method: seconds, nfev
+        and njev (function and Jacobian evaluations reported by the
+        optimizer) and the calls of each stage made by the fit
+    trace : list of tuple
+        (stage, start, seconds) of each call, with start measured from
+        the start of the with statement, if trace was set
+    elapsed : float
+        time from entering to leaving the with statement (or to now)
+        
+    Example
+    -------
+    with refl.Instrument() as inst:
+        popt, pcov = inst.curve_fit(f, s18.ang, s18.rfl, f.p0, sigmaw,
+                                    jac=f.jac)
+    inst.dump()
+    """
+    _functions = ('Parratt', 'ParrattJac', 'matR', 'gridR', 'fracs',
+                  '_fractions')
+    def __init__(self, trace: bool = False):
+        self.calls = {}
+        self.seconds = {}
+        self.fits = []
+        self.trace = [] if trace else None
+        self._lock = threading.Lock()
+        self._saved = []
+        self._start = None
+        self._end = None
+    def _wrap(self, name, fun):
+        @functools.wraps(fun)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fun(*args, **kwargs)
+            finally:
+                dt = time.perf_counter()-start
+                with self._lock:
+                    self.calls[name] = self.calls.get(name, 0)+1
+                    self.seconds[name] = self.seconds.get(name, 0.0)+dt
+                    if self.trace is not None:
+                        self.trace.append((name, start-self._start, dt))
+        return timed
+    def __enter__(self):
+        global _instrument
+        if _instrument is not None:
+            raise RuntimeError('an Instrument is already active')
+        _instrument = self
+        self._start = time.perf_counter()
+        self._end = None
+        module = sys.modules[__name__]
+        targets = [(module, name, name) for name in self._functions]
+        targets += [(Index, 'at', 'Index.at'),
+                    (MaterialSet, 'at', 'MaterialSet.at'),
+                    (Stack, '__call__', 'Stack'),
+                    (Stack, 'jac', 'Stack.jac')]
+        for owner, attr, name in targets:
+            fun = getattr(owner, attr)
+            self._saved.append((owner, attr, fun))
+            setattr(owner, attr, self._wrap(name, fun))
+        return self
+    def __exit__(self, *exc):
+        global _instrument
+        for owner, attr, fun in reversed(self._saved):
+            setattr(owner, attr, fun)
+        self._saved = []
+        self._end = time.perf_counter()
+        _instrument = None
+        return False
+    @property
+    def elapsed(self):
+        if self._start is None:
+            return 0.0
+        end = time.perf_counter() if self._end is None else self._end
+        return end-self._start
+    def curve_fit(self, f, xdata, ydata, *args, **kwargs):
+        """scipy.optimize.curve_fit, recording its evaluations and time
+        in fits; returns popt and pcov"""
+        with self._lock:
+            before = dict(self.calls)
+        start = time.perf_counter()
+        popt, pcov, info = _curve_fit(f, xdata, ydata, *args,
+                                      full_output=True, **kwargs)[:3]
+        fit = {'seconds': time.perf_counter()-start, 'nfev': info['nfev'],
+               'njev': info.get('njev')}
+        with self._lock:
+            fit['calls'] = {name: n-before.get(name, 0)
+                            for name, n in self.calls.items()
+                            if n!=before.get(name, 0)}
+        self.fits.append(fit)
+        return (popt, pcov)
+    def summary(self):
+        """the counts and times as a table, with the throughput"""
+        lines = ['{:16s} {:>9s} {:>11s} {:>11s}'.format(
+            'stage', 'calls', 'total s', 'per call s')]
+        for name in sorted(self.calls, key=self.seconds.get, reverse=True):
+            n, t = self.calls[name], self.seconds[name]
+            lines.append('{:16s} {:9d} {:11.4f} {:11.3e}'.format(
+                name, n, t, t/n))
+        elapsed = self.elapsed
+        lines.append('elapsed {:.3f} s'.format(elapsed))
+        if elapsed>0:
+            evals = self.calls.get('Parratt', 0)
+            lines.append('{:.1f} Parratt evaluations per second'.format(
+                evals/elapsed))
+            if self.fits:
+                lines.append('{} fits, {:.1f} per minute, {:.1f} function '
+                             'evaluations per fit'.format(
+                    len(self.fits), 60*len(self.fits)/elapsed,
+                    np.mean([fit['nfev'] for fit in self.fits])))
+        return '\n'.join(lines)
+    def dump(self, file=None, trace: bool = False):
+        """print the summary and, if asked, the trace"""
+        file = sys.stdout if file is None else file
+        print(self.summary(), file=file)
+        if trace and self.trace is not None:
+            for name, start, dt in self.trace:
+                print('{:12.6f} {:16s} {:11.3e}'.format(start, name, dt),
+                      file=file)
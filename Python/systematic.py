@@ -15,15 +15,13 @@ errors
 @author: rturley
 """
 
-from refl import Parratt, Index
+from refl import Parratt, prefetch
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.optimize import curve_fit
 
-AlIndex = Index("Al")
-SiIndex = Index("Si")
-SiO2Index = Index("SiO2")
-AlF3Index = Index("AlF3")
+AlIndex, SiIndex, SiO2Index, AlF3Index = prefetch(["Al", "Si", "SiO2",
+                                                   "AlF3"])
 
 wl = 12
 alndx = AlIndex.at(wl)
@@ -34,7 +32,7 @@ alf3ndx = AlF3Index.at(wl)
 n=np.array([1+0j, alf3ndx, alndx, sio2ndx, sindx])
 t=np.array([0, 18, 50, 1.6, 0])
 thr = np.linspace(0.5,80,160)
-rfl=[Parratt(n,t,thetad, wl) for thetad in thr]
+rfl=Parratt(n, t, thr, wl)
 # Add noise
 sigmap = 0.05 # proportiional noise
 sigmac = 1e-4 # constant noise
@@ -45,7 +43,7 @@ p0 = np.array([alf3ndx.real, alf3ndx.imag, 18])
 def f(thr, n, k, t):
     ndx = np.array([1+0j, n+k*1j, alndx, sindx])
     th = np.array([0, t, 50, 0])
-    return [Parratt(ndx ,th, thetad, wl) for thetad in thr]
+    return Parratt(ndx ,th, thr, wl)
 
 def print_fit(label, popt, pcov):
     print(label)
@@ -58,7 +56,7 @@ def print_fit(label, popt, pcov):
         
 ndm = np.array([1, alf3ndx, alndx, sindx])
 thm = np.array([0, 18, 50, 0])
-refm = [Parratt(ndm, thm, thetad, wl) for thetad in thr]
+refm = Parratt(ndm, thm, thr, wl)
 
 sigma = np.ones(np.size(thr))
 popt, pcov = curve_fit(f, thr, rfl, p0, sigma, absolute_sigma=False)
@@ -67,7 +65,7 @@ print_fit('exact', np.array([alf3ndx.real, alf3ndx.imag, 18]),
 print_fit('unweighted fits', popt, pcov)
 ndf = np.array([1+0j, popt[0]+popt[1]*1j, alndx, sindx])
 thf = np.array([0, popt[2], 50, 0])
-rfit = [Parratt(ndf ,thf, thetad, wl) for thetad in thr]
+rfit = Parratt(ndf, thf, thr, wl)
 
 plt.close('all')
 plt.figure()
@@ -97,7 +95,7 @@ popt, pcov = curve_fit(f, thr, rfl, p0, sigma, absolute_sigma=False)
 print_fit('prop weighted fits', popt, pcov)
 ndf = np.array([1+0j, popt[0]+popt[1]*1j, alndx, sindx])
 thf = np.array([0, popt[2], 50, 0])
-rfit = [Parratt(ndf ,thf, thetad, wl) for thetad in thr]
+rfit = Parratt(ndf, thf, thr, wl)
 
 plt.figure()
 plt.semilogy(thr, rfl, '.', thr, rfit, '-')
@@ -109,12 +107,6 @@ plt.ylabel('reflectance')
 res = (np.array(rfit)-np.array(rfl))/sigma
 plt.figure()
 plt.plot(thr, res, '.')
-<<<<<<< HEAD
-plt.title('Normalized Residual for Proportionally Weighted Fit')
-plt.xlabel('angle, degrees')
-plt.ylabel('residual')
-
-=======
 plt.title('Proportionally Weighted Fit with Systematic Error')
 plt.xlabel('angle, degrees')
 plt.ylabel('weighted residual')
@@ -122,14 +114,13 @@ plt.ylabel('weighted residual')
 plt.show()
 #
 #
->>>>>>> 3a35739dadaae29ec46abf997a80ff30d379e9cf
 ## Combined Weighted fit
 #sigma = np.sqrt((sigmap*np.array(rfl))**2+sigmac**2)
 #popt, pcov = curve_fit(f, thr, refn, p0, sigma, absolute_sigma=True)
 #print_fit('combined weighted fits', popt, pcov)
 #ndf = np.array([1+0j, popt[0]+popt[1]*1j, alndx, sio2ndx, sindx])
 #thf = np.array([0, popt[2], 50, 1.6, 0])
-#rfit = [Parratt(ndf ,thf, thetad, wl) for thetad in thr]
+#rfit = Parratt(ndf, thf, thr, wl)
 #
 #plt.figure()
 #plt.semilogy(thr, refn, '.', thr, rfit, '-', thr, rfl, '--')
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 14:40:03 2026
+"""
+
+import unittest
+import os
+import json
+import tempfile
+import numpy as np
+import batch
+from test_refl import write_beamtime, setUpModule, tearDownModule
+
+class batch_test(unittest.TestCase):
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as d:
+            write_beamtime(d)
+            model = [{'n': 1},
+                     {'n': [0.95, 0.8, 1.1], 'k': [0.02, 0, 0.2],
+                      'thickness': [8, 0, 30], 'name': 'f'},
+                     {'n': 'Si'}]
+            jobs = {'path': d, 'prefix': 'Test', 'dark': [2, 3],
+                    'models': {'film': model},
+                    'jobs': [{'name': 'good', 'runs': [[3], [2]],
+                              'i0': 4, 'windows': [[0, 40], [40, 90]],
+                              'model': 'film'},
+                             {'name': 'missing', 'runs': [[2, 9]],
+                              'i0': 4, 'model': 'film'},
+                             {'name': 'nomodel', 'runs': [[3]], 'i0': 4,
+                              'model': 'bare'},
+                             {'name': 'beam', 'runs': [[3], [2]], 'i0': 4,
+                              'windows': [[0, 40], [40, 90]],
+                              'dark': [3, 2], 'norm': 'beam',
+                              'model': 'film'},
+                             {'name': 'badnorm', 'runs': [[3]], 'i0': 4,
+                              'norm': 'gold', 'model': 'film'},
+                             {'name': 'window', 'runs': [[3], [2]],
+                              'i0': 4, 'windows': [[0, 40]],
+                              'model': 'film'}]}
+            with open(os.path.join(d, 'jobs.json'), 'w') as f:
+                json.dump(jobs, f)
+            out = os.path.join(d, 'results.txt')
+            status = batch.main([os.path.join(d, 'jobs.json'), '-o', out,
+                                 '-w', '2'])
+            self.assertEqual(status, 1)
+            table = np.loadtxt(out, dtype=str, delimiter='\t', ndmin=2)
+            header = list(table[0])
+            self.assertEqual(header[:6], ['name', 'wavelength', 'npts',
+                                          'chi2', 'seconds', 'status'])
+            self.assertIn('xf_err', header)
+            self.assertEqual(list(table[1:,0]), ['good', 'missing',
+                                                 'nomodel', 'beam',
+                                                 'badnorm', 'window'])
+            good = dict(zip(header, table[1]))
+            self.assertEqual(good['status'], 'ok')
+            self.assertTrue(40 < int(good['npts']) < 60)
+            self.assertGreater(float(good['seconds']), 0)
+            self.assertGreater(int(good['nfev']), 0)
+            self.assertTrue(0.8 <= float(good['nf']) <= 1.1)
+            self.assertNotEqual(table[2,5], 'ok')
+            self.assertTrue(table[3,5].startswith('KeyError'))
+            # dark runs and normalization set for one job
+            self.assertEqual(table[4,5], 'ok')
+            self.assertTrue(table[5,5].startswith('ValueError'))
+            self.assertTrue(table[6,5].startswith('ValueError'))
+            # no dark runs for the file or the job
+            del jobs['dark']
+            rows = batch.runJobs(dict(jobs, jobs=jobs['jobs'][:1]), 1)
+            self.assertEqual(rows[0]['status'],
+                             'ValueError: no dark runs given')
+
+if __name__ == '__main__':
+    unittest.main()
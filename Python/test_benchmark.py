@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 17:05:36 2026
+"""
+
+import unittest
+import benchmark
+
+class benchmark_test(unittest.TestCase):
+    def test_run(self):
+        new = benchmark.run(['parratt_point', 'reflectance_filter'], 2,
+                            0.001)
+        self.assertEqual(sorted(new['results']), ['parratt_point',
+                                                  'reflectance_filter'])
+        r = new['results']['parratt_point']
+        self.assertLessEqual(r['min'], r['median'])
+        old = {'results': {'parratt_point': {'median': r['median']/2},
+                           'fit_stack': {'median': 1.0}}}
+        rows = benchmark.compare(new, old, 0.25)
+        self.assertEqual(len(rows), 1)
+        name, before, after, ratio, slow = rows[0]
+        self.assertEqual(name, 'parratt_point')
+        self.assertAlmostEqual(ratio, 2)
+        self.assertTrue(slow)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 09:40:12 2026
+
+"""
+
+import unittest
+import time
+import tempfile
+import refl
+import fitting
+import numpy as np
+from test_refl import write_beamtime, setUpModule, tearDownModule
+
+class fitting_test(unittest.TestCase):
+    def setUp(self):
+        self.wl = 12
+        self.n = np.array([1+0j, 0.95+0.006j, 0.9+0.02j, 0.93+0.01j])
+        self.t = np.array([0, 18, 50, 0])
+        self.thr = np.linspace(0.5, 80, 80)
+        self.rfl = refl.Parratt(self.n, self.t, self.thr, self.wl)
+        self.f, self.jac = refl.ParrattFit(self.n, self.t, self.wl,
+                                           [('n',1), ('k',1), ('x',1)])
+        self.exact = np.array([0.95, 0.006, 18])
+
+    def test_multistart(self):
+        bounds = ([0.85, 0, 10], [1.05, 0.05, 30])
+        minima = fitting.multistart(self.f, self.thr, self.rfl, bounds, 8,
+                                    0.05*self.rfl, jac=self.jac, workers=2,
+                                    seed=3)
+        chi2 = [m.chi2 for m in minima]
+        self.assertEqual(chi2, sorted(chi2))
+        self.assertLessEqual(sum(m.count for m in minima), 8)
+        np.testing.assert_allclose(minima[0].popt, self.exact, rtol=1e-5)
+        self.assertEqual(minima[0].pcov.shape, (3, 3))
+        with self.assertRaises(ValueError):
+            fitting.multistart(self.f, self.thr, self.rfl,
+                               ([0.85, 0, 10], [1.05, np.inf, 30]), 4,
+                               workers=1)
+    def test_montecarlo(self):
+        mc = fitting.montecarlo(self.f, self.thr, self.exact, 0.05, 1e-4, 40,
+                                0.05*self.rfl, jac=self.jac, workers=2,
+                                seed=5)
+        self.assertEqual(mc.params.shape, (40, 3))
+        self.assertEqual(mc.nfail, 0)
+        self.assertEqual(mc.cov.shape, (3, 3))
+        np.testing.assert_allclose(np.sqrt(np.diag(mc.cov)), mc.rms)
+        self.assertTrue(np.all(np.abs(mc.mean-self.exact) < 5*mc.rms))
+    def test_bootstrap(self):
+        rng = np.random.RandomState(7)
+        refn = self.rfl*(1+0.05*rng.standard_normal(self.thr.size))
+        for mode in ('pairs', 'residuals'):
+            bs = fitting.bootstrap(self.f, self.thr, refn, self.exact,
+                                   0.05*self.rfl, 60, mode, jac=self.jac,
+                                   batch=20, rtol=0, workers=2, seed=1)
+            self.assertEqual(bs.n, 60)
+            self.assertFalse(bs.converged)
+            self.assertTrue(np.all(bs.interval[0] < bs.interval[1]))
+            self.assertTrue(np.all(np.abs(bs.mean-self.exact) < 5*bs.rms))
+        bs = fitting.bootstrap(self.f, self.thr, refn, self.exact,
+                               0.05*self.rfl, 400, jac=self.jac, batch=20,
+                               rtol=0.5, workers=1, seed=1)
+        self.assertTrue(bs.converged)
+        self.assertLess(bs.n, 400)
+        self.assertEqual(bs.params.shape, (bs.n, 3))
+        self.assertIsNone(fitting._job)
+        self.assertRaises(ValueError, fitting.bootstrap, self.f, self.thr,
+                          refn, self.exact, nboot=0, workers=1)
+        def fail(thr, *p):
+            # the model at popt, but every fit fails
+            if np.any(p!=self.exact):
+                raise RuntimeError('no fit')
+            return self.rfl
+        self.assertRaises(RuntimeError, fitting.bootstrap, fail, self.thr,
+                          refn, self.exact, nboot=4, workers=1)
+    def test_fitseries(self):
+        series = []
+        for x0 in (18, 22):
+            spectra = []
+            for i in range(6):
+                r = refl.Reflectance()._like(
+                    self.thr, self.f(self.thr, 0.95, 0.006, x0+0.5*i))
+                r.wavelength = self.wl
+                spectra.append(r)
+            series.append(spectra)
+        sigma = lambda ang, rfl: 0.05*rfl
+        warm = fitting.fitseries(self.f, series, self.exact, [np.arange(6)*7,
+                                 None], sigma, self.jac, workers=2)
+        cold = fitting.fitseries(self.f, series, self.exact, None, sigma,
+                                 self.jac, warm=False, workers=1)
+        self.assertEqual(len(warm), 2)
+        np.testing.assert_array_equal(warm[0].times, np.arange(6)*7)
+        np.testing.assert_array_equal(warm[1].times, np.arange(6))
+        for w, c, x0 in zip(warm, cold, (18, 22)):
+            self.assertEqual(w.params.shape, (6, 3))
+            np.testing.assert_allclose(w.params[:,2], x0+0.5*np.arange(6),
+                                       rtol=1e-5)
+            self.assertLess(np.sum(w.nfev), np.sum(c.nfev))
+    def test_LiveFit(self):
+        with tempfile.TemporaryDirectory() as d:
+            write_beamtime(d, npts=100)
+            log = refl.Log(d, 'Test')
+            runs = refl.Runs(log)
+            with open(log.fullname[3]) as f:
+                lines = f.readlines()
+            with open(log.fullname[3], 'w') as f:
+                f.writelines(lines[:11])
+            fits = []
+            model = lambda th, a, b: a*np.exp(-th/b)
+            live = fitting.LiveFit(refl.RunTail(log, 3), runs[4],
+                                   (0, 3, 4), model, [1, 10], 30,
+                                   callback=lambda fit: fits.append(fit.npts))
+            live.start(0.01)
+            for i in range(11, 101, 10):
+                with open(log.fullname[3], 'a') as f:
+                    f.writelines(lines[i:i+10])
+                time.sleep(0.05)
+            live.stop()
+            self.assertEqual(live.spectrum.ang.size, 100)
+            self.assertIsNone(live.error)
+            self.assertGreater(len(fits), 1)
+            self.assertEqual(fits, sorted(fits))
+            self.assertEqual(fits[-1], 100)
+            self.assertAlmostEqual(live.popt[1], 20, 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,8 +6,31 @@ Created on Fri Apr 13 17:46:36 2018
 """
 
 import unittest
+import os
+import shutil
+import pathlib
+import tempfile
 import refl
 import numpy as np
+from benchmark import writeBeamtime
+
+_nk = None
+
+def setUpModule():
+    # index tables come from the bundled files through a scratch cache,
+    # never from volta or the user's cache
+    global _nk
+    _nk = (refl.nkurl, refl.nkcache, tempfile.mkdtemp())
+    refl.nkurl = pathlib.Path(_nk[2], 'volta').as_uri()+'/'
+    refl.nkcache = _nk[2]
+
+def tearDownModule():
+    refl.nkurl, refl.nkcache = _nk[:2]
+    shutil.rmtree(_nk[2])
+
+def write_beamtime(path, prefix='Test', npts=50):
+    """write a small log file and four runs, with gains 9, 7, 8 and 8"""
+    writeBeamtime(path, prefix, 4, npts, (9, 7, 8, 8))
 
 class refl_test(unittest.TestCase):
     def setUp(self):
@@ -43,5 +66,433 @@ class refl_test(unittest.TestCase):
         self.assertAlmostEqual(rm, 0.01260649028, 7)
         self.assertAlmostEqual(rp, rm, 8)
 
+    def test_Parratt_angle_array(self):
+        lam = 15
+        n = np.array([1, self.AlIndex.at(lam), self.SiO2Index.at(lam)])
+        t = np.array([0, 20, 0])
+        sigma = np.array([0.5, 1.0])
+        thr = np.linspace(0.5, 80, 160)
+        ra = refl.Parratt(n, t, thr, lam, 0, sigma)
+        self.assertEqual(ra.shape, thr.shape)
+        for thetad, r in zip(thr, ra):
+            self.assertAlmostEqual(r, refl.Parratt(n, t, thetad, lam, 0,
+                                                   sigma), 12)
+
+    def test_ParrattCache(self):
+        lam = 15
+        n = np.array([1, 0.95+0.01j, self.AlIndex.at(lam),
+                      self.SiO2Index.at(lam)])
+        t = np.array([0, 8.0, 20, 0])
+        sigma = np.array([0.5, 1.0, 0.3])
+        thr = np.linspace(0.5, 80, 160)
+        cache = refl.ParrattCache()
+        for i, j in enumerate([0, 1, 1, 3, 2, 1]):
+            t[j] += 0.5
+            n[j] += 0.001j
+            sigma[min(j, 2)] += 0.1
+            np.testing.assert_array_equal(
+                refl.Parratt(n, t, thr, lam, 0, sigma, cache),
+                refl.Parratt(n, t, thr, lam, 0, sigma))
+        np.testing.assert_array_equal(
+            refl.Parratt(n, t, thr[::2], lam, 0, sigma, cache),
+            refl.Parratt(n, t, thr[::2], lam, 0, sigma))
+
+    def test_roughness(self):
+        lam = 15
+        n = np.array([1, 0.97+0.01j, self.AlIndex.at(lam),
+                      self.SiO2Index.at(lam)])
+        t = np.array([0, 8.0, 20, 0])
+        thr = np.linspace(1, 60, 30)
+        smooth = refl.Parratt(n, t, thr, lam)
+        for model in ('nevot-croce', 'graded'):
+            np.testing.assert_allclose(
+                refl.Parratt(n, t, thr, lam, 0, 0, roughness=model), smooth,
+                rtol=1e-12)
+        self.assertRaises(ValueError, refl.Parratt, n, t, thr, lam, 0, 0,
+                          roughness='gaussian')
+        sigma = np.array([0.5, 1.0, 0.3])
+        ns, xs = refl.graded(n, t, sigma, 16)
+        self.assertEqual(ns.shape, (4+3*16,))
+        # the outer slices reach 3 sigma into the incident layer and
+        # the substrate
+        self.assertAlmostEqual(np.sum(xs), np.sum(t)+3*(0.5+0.3))
+        np.testing.assert_allclose((ns[8]+ns[9])/2, (n[0]+n[1])/2,
+                                   rtol=1e-6)
+        fine = refl.Parratt(n, t, thr, lam, 0, sigma, roughness='graded',
+                            nslice=64)
+        coarse = refl.Parratt(n, t, thr, lam, 0, sigma, roughness='graded',
+                              nslice=16)
+        np.testing.assert_allclose(coarse, fine, rtol=1e-2)
+        # the Nevot-Croce factor is close to the graded profile at low
+        # angles, Debye-Waller is further off
+        nc = refl.Parratt(n, t, thr, lam, 0, sigma, roughness='nevot-croce')
+        dw = refl.Parratt(n, t, thr, lam, 0, sigma)
+        self.assertLess(np.abs(nc/fine-1)[0], np.abs(dw/fine-1)[0])
+
+    def test_gridR(self):
+        wl = np.linspace(12, 40, 5)
+        thr = np.linspace(1, 80, 7)
+        t = np.array([0, 20, 0])
+        r = refl.gridR([1, self.AlIndex, self.SiO2Index], t, thr, wl)
+        self.assertEqual(r.shape, (wl.size, thr.size))
+        for i, lam in enumerate(wl):
+            n = np.array([1, self.AlIndex.at(lam), self.SiO2Index.at(lam)])
+            rp = refl.Parratt(n, t, thr, lam)
+            np.testing.assert_allclose(r[i], rp, rtol=1e-10)
+    def test_matR_array(self):
+        lam = np.array([[15], [30.4]])
+        thr = np.linspace(1, 80, 50)
+        n = np.array([[1, self.AlIndex.at(15), self.SiO2Index.at(15)],
+                      [1, self.AlIndex.at(30.4), self.SiO2Index.at(30.4)]])
+        t = np.array([0, 20, 0])
+        rm = refl.matR(n[:,np.newaxis,:], t, thr, lam)[0]
+        self.assertEqual(rm.shape, (2, thr.size))
+        self.assertAlmostEqual(rm[0,0], refl.matR(n[0], t, 1, 15)[0], 12)
+        rp = refl.Parratt(n[:,np.newaxis,:], t, thr, lam)
+        np.testing.assert_allclose(rm, rp, rtol=1e-8)
+    def test_ParrattJac(self):
+        lam = 15
+        n = np.array([1, 0.98+0.01j, self.AlIndex.at(lam),
+                      self.SiO2Index.at(lam)])
+        t = np.array([0, 8, 20, 0])
+        sigma = np.array([0.5, 1.0, 0.3])
+        thr = np.linspace(1, 80, 20)
+        r, dn, dk, dx, ds = refl.ParrattJac(n, t, thr, lam, 0, sigma)
+        np.testing.assert_allclose(r, refl.Parratt(n, t, thr, lam, 0, sigma),
+                                   rtol=1e-12)
+        h = 1e-6
+        for j in range(1, 4):
+            e = np.zeros(4)
+            e[j] = h
+            fd = (refl.Parratt(n+e, t, thr, lam, 0, sigma)-
+                  refl.Parratt(n-e, t, thr, lam, 0, sigma))/(2*h)
+            np.testing.assert_allclose(dn[:,j], fd, atol=1e-6)
+            fd = (refl.Parratt(n+1j*e, t, thr, lam, 0, sigma)-
+                  refl.Parratt(n-1j*e, t, thr, lam, 0, sigma))/(2*h)
+            np.testing.assert_allclose(dk[:,j], fd, atol=1e-6)
+            fd = (refl.Parratt(n, t+e, thr, lam, 0, sigma)-
+                  refl.Parratt(n, t-e, thr, lam, 0, sigma))/(2*h)
+            np.testing.assert_allclose(dx[:,j], fd, atol=1e-6)
+            fd = (refl.Parratt(n, t, thr, lam, 0, sigma+e[1:])-
+                  refl.Parratt(n, t, thr, lam, 0, sigma-e[1:]))/(2*h)
+            np.testing.assert_allclose(ds[:,j-1], fd, atol=1e-6)
+
+    def test_ParrattFit(self):
+        lam = 15
+        n = np.array([1, 0.98+0.01j, self.AlIndex.at(lam),
+                      self.SiO2Index.at(lam)])
+        t = np.array([0, 8, 20, 0])
+        thr = np.linspace(1, 80, 20)
+        f, jac = refl.ParrattFit(n, t, lam, [('n',1), ('k',1), ('x',2)])
+        np.testing.assert_allclose(f(thr, 0.98, 0.01, 20),
+                                   refl.Parratt(n, t, thr, lam), rtol=1e-12)
+        d = refl.ParrattJac(n, t, thr, lam)
+        J = jac(thr, 0.98, 0.01, 20)
+        self.assertEqual(J.shape, (thr.size, 3))
+        np.testing.assert_allclose(J[:,0], d[1][:,1], rtol=1e-12)
+        np.testing.assert_allclose(J[:,1], d[2][:,1], rtol=1e-12)
+        np.testing.assert_allclose(J[:,2], d[3][:,2], rtol=1e-12)
+    def test_nkTable_registry(self):
+        self.assertIs(refl.nkTable('Al'), refl.nkTable('Al'))
+        idx = refl.prefetch(['Al', 'Si', 'SiO2'])
+        self.assertAlmostEqual(idx[1].at(30.4), self.SiIndex.at(30.4), 12)
+
+    def test_nkTable_cache(self):
+        nkcache = refl.nkcache
+        with tempfile.TemporaryDirectory() as d:
+            with open(os.path.join(d, 'Test.nk'), 'w') as f:
+                f.write('; test material\n; Lambda (A) n k\n'
+                        '100 0.9 0.01\n200 0.8 0.02\n')
+            refl.nkcache = d
+            try:
+                lam, ndx = refl.nkTable('Test')
+            finally:
+                refl.nkcache = nkcache
+        np.testing.assert_allclose(lam, [10, 20])
+        np.testing.assert_allclose(ndx, [0.9+0.01j, 0.8+0.02j])
+    def test_nkTable_fallback(self):
+        # volta sends an error page, so the bundled table is used and
+        # cached in its place
+        saved = (refl.nkurl, refl.nkcache, refl.nkbundled)
+        with tempfile.TemporaryDirectory() as d:
+            for sub in ('volta', 'cache', 'bundled'):
+                os.mkdir(os.path.join(d, sub))
+            with open(os.path.join(d, 'volta', 'Bad.nk'), 'w') as f:
+                f.write('<html>Service Unavailable</html>\n')
+            good = '; Lambda (A) n k\n100 0.9 0.01\n200 0.8 0.02\n'
+            with open(os.path.join(d, 'bundled', 'Bad.nk'), 'w') as f:
+                f.write(good)
+            refl.nkurl = 'file://'+os.path.join(d, 'volta')+'/'
+            refl.nkcache = os.path.join(d, 'cache')
+            refl.nkbundled = os.path.join(d, 'bundled')
+            try:
+                lam, ndx = refl.nkTable('Bad')
+            finally:
+                refl.nkurl, refl.nkcache, refl.nkbundled = saved
+                refl._nktables.pop('Bad', None)
+            np.testing.assert_allclose(lam, [10, 20])
+            self.assertEqual(os.listdir(os.path.join(d, 'cache')),
+                             ['Bad.nk'])
+            with open(os.path.join(d, 'cache', 'Bad.nk')) as f:
+                self.assertEqual(f.read(), good)
+    def test_Index_window(self):
+        al2o3 = refl.Index('Al2O3', 'pchip', 35, 50)
+        self.assertTrue(np.all(al2o3.lam >= 35) and np.all(al2o3.lam <= 50))
+        np.testing.assert_allclose(al2o3.at(al2o3.lam), al2o3.ndx,
+                                   rtol=1e-12)
+        self.assertRaises(ValueError, al2o3.at, 60)
+        self.assertRaises(ValueError, refl.Index, 'Al', 'quintic')
+
+    def test_MaterialSet(self):
+        mats = refl.MaterialSet([1, self.AlIndex, 'SiO2', self.SiIndex])
+        wl = np.linspace(12, 40, 50)
+        n = mats.at(wl)
+        self.assertEqual(n.shape, (wl.size, 4))
+        np.testing.assert_allclose(n[:,0], 1)
+        np.testing.assert_allclose(n[:,1], self.AlIndex.at(wl), rtol=1e-12)
+        np.testing.assert_allclose(n[:,2], self.SiO2Index.at(wl), rtol=1e-12)
+        np.testing.assert_allclose(n[:,3], self.SiIndex.at(wl), rtol=1e-12)
+    def test_Log_Run(self):
+        with tempfile.TemporaryDirectory() as d:
+            write_beamtime(d)
+            log = refl.Log(d, 'Test')
+            run = refl.Run(log, 2)
+        self.assertEqual(log.filename, ['', 'Test1.dat', 'Test2.dat',
+                                        'Test3.dat', 'Test4.dat'])
+        self.assertEqual(log.fullname[3], d+'/Test3.dat')
+        self.assertEqual(log.comment[1], 'run 1')
+        self.assertEqual(log.time[4], '10:04')
+        np.testing.assert_array_equal(log.gain, [0, 9, 7, 8, 8])
+        np.testing.assert_array_equal(log.wavelength, [0, 15, 15, 15, 15])
+        self.assertEqual(log.columns[3].dtype.kind, 'U')
+        self.assertEqual(log.columns[0].dtype.kind, 'f')
+        self.assertEqual(run.gain, 7)
+        self.assertEqual(run.comment, 'run 2')
+        self.assertEqual(run.var.size, 50)
+        self.assertAlmostEqual(run.var[0], 1.2)
+        self.assertAlmostEqual(run.diode[0], 1e7*np.exp(-1.2/20)+2)
+        np.testing.assert_array_equal(run.beam, 500)
+    def test_archive(self):
+        with tempfile.TemporaryDirectory() as d:
+            write_beamtime(d)
+            log = refl.Log(d, 'Test')
+            fname = os.path.join(d, 'Test.bin')
+            refl.writeArchive(log, fname)
+            runs = refl.openArchive(fname)
+            self.assertEqual(runs.log.comment, log.comment)
+            np.testing.assert_array_equal(runs.log.gain, log.gain)
+            for run in range(1, 5):
+                r = refl.Run(log, run)
+                ra = runs[run]
+                self.assertIsInstance(ra.diode.base, np.memmap)
+                np.testing.assert_array_equal(ra.var, r.var)
+                np.testing.assert_array_equal(ra.diode, r.diode)
+                np.testing.assert_array_equal(ra.beam, r.beam)
+                self.assertEqual(ra.gain, r.gain)
+            del runs, ra
+            # a missing and a corrupt run are reported, not archived
+            os.remove(os.path.join(d, 'Test2.dat'))
+            with open(os.path.join(d, 'Test3.dat'), 'w') as f:
+                f.write('theta\tdiode\tm3\tbeam\n1.0\tjunk\n')
+            with self.assertWarns(UserWarning):
+                dropped = refl.writeArchive(log, fname)
+            self.assertEqual(sorted(dropped), [2, 3])
+            runs = refl.openArchive(fname)
+            self.assertEqual(sorted(runs.dropped), [2, 3])
+            self.assertRaises(ValueError, runs.__getitem__, 2)
+            self.assertRaises(ValueError, runs.__getitem__, 3)
+            np.testing.assert_array_equal(runs[4].diode,
+                                          refl.Run(log, 4).diode)
+            self.assertEqual(runs.archive[0].shape, (4, 100))
+            del runs
+    def test_Runs_cache(self):
+        with tempfile.TemporaryDirectory() as d:
+            write_beamtime(d)
+            log = refl.Log(d, 'Test')
+            runs = refl.Runs(log, maxbytes=2*4*50*8)
+            r1 = runs[1]
+            self.assertIs(runs[1], r1)
+            runs[2]
+            runs[3]
+            self.assertEqual(list(runs.rn), ['2', '3'])
+            self.assertEqual(runs.nbytes, 2*4*50*8)
+            for f in runs.prefetch([4, 4, 1]):
+                f.result()
+            self.assertIs(runs[4], runs.rn['4'])
+            self.assertEqual(len(runs.rn), 2)
+            self.assertRaises(IndexError, runs.__getitem__, 7)
+    def test_Reflectance(self):
+        with tempfile.TemporaryDirectory() as d:
+            write_beamtime(d)
+            runs = refl.Runs(refl.Log(d, 'Test'))
+            dark = (1.0, 2.0, 3.0, 4.0)
+            a = refl.Reflectance((runs[3], runs[2]), runs[1], dark)
+            b = refl.Reflectance((runs[4],), runs[1], dark)
+        self.assertEqual(a.ang.size, 100)
+        self.assertTrue(np.all(np.diff(a.ang) >= 0))
+        r0 = (1e9*np.exp(-15/20)+1-3)/1e9
+        i = np.searchsorted(a.ang, 1.2)
+        self.assertAlmostEqual(a.rfl[i], (1e7*np.exp(-1.2/20)+2-1)/1e7/r0,
+                               4)
+        f = a.filter(10, 40)
+        self.assertTrue(np.shares_memory(f.ang, a.ang))
+        self.assertTrue(np.all((f.ang >= 10) & (f.ang <= 40)))
+        self.assertEqual(f.ang.size, np.sum((a.ang >= 10) & (a.ang <= 40)))
+        s = a.filter(2, 18)+b.filter(18.05, 80)
+        ang = np.concatenate((a.filter(2, 18).ang, b.filter(18.05, 80).ang))
+        rfl = np.concatenate((a.filter(2, 18).rfl, b.filter(18.05, 80).rfl))
+        order = np.argsort(ang, kind='stable')
+        np.testing.assert_array_equal(s.ang, ang[order])
+        np.testing.assert_array_equal(s.rfl, rfl[order])
+        self.assertEqual(s.wavelength, 15)
+    def test_Calibration(self):
+        with tempfile.TemporaryDirectory() as d:
+            write_beamtime(d)
+            log = refl.Log(d, 'Test')
+            refl.writeArchive(log, os.path.join(d, 'Test.bin'))
+            runs = refl.openArchive(os.path.join(d, 'Test.bin'))
+            cal = refl.Calibration(runs, (2, 3, 4))
+            dark8 = (np.mean(runs[3].diode)+np.mean(runs[4].diode))/2
+            np.testing.assert_allclose(cal.dark([7, 8, 8]),
+                [np.mean(runs[2].diode), dark8, dark8])
+            self.assertRaises(ValueError, cal.dark, 9)
+            a = refl.Reflectance((runs[3], runs[2]), runs[4], cal)
+            b = refl.Reflectance((runs[3], runs[2]), runs[4],
+                                 (np.mean(runs[2].diode), dark8))
+            np.testing.assert_allclose(a.rfl, b.rfl, rtol=1e-12)
+            beam = refl.Calibration(runs, (2, 3, 4), 'beam')
+            sig, off = beam.signals()
+            np.testing.assert_array_equal(off, runs.archive[1])
+            self.assertTrue(np.all(np.isnan(sig[off[1]:off[2]])))
+            np.testing.assert_allclose(sig[off[2]:off[3]],
+                                       beam.signal(runs[2]), rtol=1e-12)
+            np.testing.assert_allclose(beam.signal(runs[2]),
+                                       cal.signal(runs[2])/500, rtol=1e-12)
+            self.assertRaises(ValueError, refl.Calibration(runs, ()).dark, 8)
+            self.assertRaises(ValueError,
+                              refl.Calibration(refl.Runs(log), (2,)).signals)
+            del runs, a, b, cal, beam
+    def test_Polarization(self):
+        lam = np.linspace(1.5, 100, 50)
+        np.testing.assert_allclose(refl.fracs(lam),
+            (refl.frfunc(np.log10(1239.8/lam))+1)/2, rtol=1e-12)
+        self.assertRaises(ValueError, refl.fracs, 200)
+        self.assertEqual(refl._sfracs(200), 1.0)
+        flat = refl.Polarization([[10, 0.6], [100, 0.6], [1000, 0.6]],
+                                 'flat', 'linear', outside=0.5)
+        refl.addPolarization(flat)
+        self.assertIs(refl.polarization('flat'), flat)
+        self.assertRaises(ValueError, refl.polarization, 'none')
+        np.testing.assert_allclose(refl.fracs([15, 200, 500], 'flat'),
+                                   [0.8, 0.5, 0.5])
+        n = np.array([1, self.AlIndex.at(15), self.SiO2Index.at(15)])
+        t = np.array([0, 20, 0])
+        np.testing.assert_allclose(refl.Parratt(n, t, 20, 15, 'flat'),
+                                   refl.Parratt(n, t, 20, 15, 0.8),
+                                   rtol=1e-12)
+        np.testing.assert_allclose(refl.matR(n, t, 20, 15, 0, flat)[0],
+                                   refl.Parratt(n, t, 20, 15, 0.8),
+                                   rtol=1e-8)
+        st = refl.Stack([refl.Layer(1), refl.Layer('Al', thickness=20),
+                         refl.Layer('SiO2')], 15, 'flat')
+        self.assertEqual(st.fractions, 0.8)
+        del refl.polarizations['flat']
+    def test_Instrument(self):
+        Free, Layer = refl.Free, refl.Layer
+        f = refl.Stack([Layer(1), Layer(Free(0.95), Free(0.025), Free(8)),
+                        Layer('Al', thickness=20), Layer('SiO2')], 15)
+        thr = np.linspace(2, 80, 100)
+        rfl = f(thr, 0.93, 0.03, 9.5)
+        parratt = refl.Parratt
+        with refl.Instrument(trace=True) as inst:
+            self.assertRaises(RuntimeError, refl.Instrument().__enter__)
+            popt, pcov = inst.curve_fit(f, thr, rfl, f.p0, jac=f.jac)
+            self.AlIndex.at(15)
+        self.assertIs(refl.Parratt, parratt)
+        np.testing.assert_allclose(popt, [0.93, 0.03, 9.5], rtol=1e-6)
+        fit, = inst.fits
+        self.assertEqual(fit['calls']['Stack'], fit['nfev'])
+        self.assertEqual(fit['calls']['Parratt'], fit['nfev'])
+        self.assertEqual(inst.calls['Index.at'], 1)
+        self.assertEqual(len(inst.trace), sum(inst.calls.values()))
+        self.assertGreater(inst.elapsed, inst.seconds['Stack'])
+        self.assertIn('Parratt', inst.summary())
+    def test_RunTail(self):
+        with tempfile.TemporaryDirectory() as d:
+            write_beamtime(d)
+            log = refl.Log(d, 'Test')
+            runs = refl.Runs(log)
+            dark = (0, 3, 4)
+            full = refl.Reflectance((runs[3],), runs[4], dark)
+            with open(log.fullname[3], 'rb') as f:
+                text = f.read()
+            with open(log.fullname[3], 'wb') as f:
+                f.write(text[:1000])
+            tail = refl.RunTail(log, 3)
+            spectrum = refl.Reflectance()
+            new = tail.read()
+            spectrum.extend(refl.Reflectance((new,), runs[4], dark))
+            self.assertEqual(tail.npts, new.var.size)
+            self.assertLess(tail.npts, 50)
+            self.assertIsNone(tail.read())
+            with open(log.fullname[3], 'ab') as f:
+                f.write(text[1000:])
+            spectrum.extend(refl.Reflectance((tail.read(),), runs[4], dark))
+            self.assertEqual(tail.npts, 50)
+            self.assertEqual(spectrum.wavelength, 15)
+            np.testing.assert_array_equal(spectrum.ang, full.ang)
+            np.testing.assert_allclose(spectrum.rfl, full.rfl, rtol=1e-12)
+    def test_Stack(self):
+        lam = 15
+        Free = refl.Free
+        st = refl.Stack([refl.Layer(1),
+                         refl.Layer(Free(0.98, 0.9, 1.0), Free(0.01), 8,
+                                    Free(0.5, 0, 2)),
+                         refl.Layer(self.AlIndex, thickness=Free(20),
+                                    name='a'),
+                         refl.Layer('SiO2', sigma=0.3)], lam)
+        self.assertEqual(st.names, ['n1', 'k1', 'sigma1', 'xa'])
+        np.testing.assert_array_equal(st.p0, [0.98, 0.01, 0.5, 20])
+        np.testing.assert_array_equal(st.bounds[0], [0.9, -np.inf, 0,
+                                                     -np.inf])
+        n = np.array([1, 0.97+0.02j, self.AlIndex.at(lam),
+                      self.SiO2Index.at(lam)])
+        t = np.array([0, 8, 25, 0])
+        sigma = np.array([0.7, 0, 0.3])
+        thr = np.linspace(1, 80, 30)
+        p = [0.97, 0.02, 0.7, 25]
+        np.testing.assert_allclose(st(thr, *p),
+                                   refl.Parratt(n, t, thr, lam, 0, sigma),
+                                   rtol=1e-12)
+        f, jac = refl.ParrattFit(n, t, lam, [('n',1), ('k',1),
+                                             ('sigma',0), ('x',2)], 0, sigma)
+        np.testing.assert_allclose(st.jac(thr, *p), jac(thr, *p),
+                                   rtol=1e-12)
+        np.testing.assert_allclose(st.residuals(p, thr, 0, 2),
+                                   st(thr, *p)/2, rtol=1e-12)
+
+    def test_JointStack(self):
+        Free, Layer = refl.Free, refl.Layer
+        thr = np.linspace(1, 60, 40)
+        exact = [(12, 0.92, 0.02), (15, 0.95, 0.03), (20, 0.97, 0.01)]
+        spectra = []
+        for lam, n, k in exact:
+            st = refl.Stack([Layer(1), Layer(n, k, 14, 0.8),
+                             Layer('Al', thickness=20), Layer('SiO2')], lam)
+            r = refl.Reflectance()._like(thr, st(thr))
+            r.wavelength, r.frs = lam, refl.fracs(lam)
+            spectra.append(r)
+        joint = refl.JointStack(
+            [Layer(1), Layer(Free(0.95, 0.8, 1.1), Free(0.025, 0, 0.2),
+                             Free(12, 0, 30), Free(1, 0, 3), name='f'),
+             Layer('Al', thickness=20), Layer('SiO2')], spectra)
+        self.assertEqual(joint.names[:4], ['xf', 'sigmaf', 'nf@12', 'kf@12'])
+        self.assertEqual(joint.sparsity.shape, (3*thr.size, 8))
+        self.assertEqual(joint.sparsity.nnz, 3*thr.size*4)
+        res = joint.fit()
+        np.testing.assert_allclose(res.x, [14, 0.8]+[v for e in exact
+                                                     for v in e[1:]],
+                                   rtol=1e-5)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
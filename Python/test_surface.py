@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 16:02:47 2026
+"""
+
+import unittest
+import os
+import tempfile
+import numpy as np
+import Surface
+
+class surface_test(unittest.TestCase):
+    def test_synthesize(self):
+        psd = Surface.gaussianPSD(0.5, 10, 2)
+        h = Surface.synthesize((256, 512), 1.0, psd, seed=1)
+        self.assertEqual(h.shape, (256, 512))
+        self.assertAlmostEqual(np.mean(h), 0, 12)
+        self.assertAlmostEqual(Surface.rms(h), np.std(h), 12)
+        self.assertAlmostEqual(Surface.rms(h), 0.5, 1)
+        np.testing.assert_array_equal(
+            h, Surface.synthesize((256, 512), 1.0, psd, seed=1, block=100))
+        # the line PSD of a Gaussian surface is the 1-d Gaussian PSD
+        r, c = Surface.autocorrelation(h, 1.0)
+        self.assertAlmostEqual(c[0], np.mean(h**2), 12)
+        self.assertAlmostEqual(c[10]/c[0], np.exp(-1), 1)
+        k, p = Surface.psd(h, 1.0)
+        self.assertAlmostEqual((2*np.sum(p)-p[0]-p[-1])*(k[1]-k[0])/2/np.pi,
+                               np.mean(h**2), 12)
+    def test_power(self):
+        # narrow surfaces, so the kx=0 column carries a fifth of the power
+        psd = Surface.gaussianPSD(0.5, 8, 2)
+        hs = [Surface.synthesize((4096, 64), 1.0, psd, seed=s)
+              for s in range(4)]
+        self.assertAlmostEqual(np.mean([np.mean(h**2) for h in hs])/0.25,
+                               1, delta=0.05)
+        k, p = Surface.psd(np.concatenate(hs), 1.0)
+        np.testing.assert_allclose(p[:8], Surface.gaussianPSD(0.5, 8)(k[:8]),
+                                   rtol=0.1)
+        # and a line with an even number of points keeps its Nyquist power
+        psd = Surface.exponentialPSD(0.5, 0.5)
+        h = [Surface.synthesize(64, 1.0, psd, seed=s) for s in range(200)]
+        k, p = Surface.psd(np.array(h), 1.0)
+        self.assertAlmostEqual(p[-1]/psd(k[-1]), 1, delta=0.3)
+    def test_memmap(self):
+        psd = Surface.exponentialPSD(0.2, 5)
+        h = Surface.synthesize(4096, 0.5, psd, seed=2)
+        with tempfile.TemporaryDirectory() as d:
+            name = os.path.join(d, 'line.dat')
+            m = Surface.synthesize(4096, 0.5, psd, seed=2, dtype=np.float32,
+                                   filename=name)
+            self.assertIsInstance(m, np.memmap)
+            self.assertEqual(os.path.getsize(name), 4096*4)
+            np.testing.assert_allclose(m, h, atol=1e-5)
+            del m
+    def test_Surface(self):
+        s = Surface.Surface(0.1, 500.0, 4096, corrlen=20, seed=3)
+        self.assertEqual(s.yp.shape, s.xp.shape)
+        self.assertAlmostEqual(Surface.rms(s.yp), 0.1, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,14 +7,13 @@ empirically computing uncertainty
 @author: rturley
 """
 
-from refl import Parratt, Index
+from refl import Parratt, prefetch
+from fitting import montecarlo
 import numpy as np
 from scipy.optimize import curve_fit
 
-AlIndex = Index("Al")
-SiIndex = Index("Si")
-SiO2Index = Index("SiO2")
-AlF3Index = Index("AlF3")
+AlIndex, SiIndex, SiO2Index, AlF3Index = prefetch(["Al", "Si", "SiO2",
+                                                   "AlF3"])
 
 wl = 12
 alndx = AlIndex.at(wl)
@@ -25,7 +24,7 @@ alf3ndx = AlF3Index.at(wl)
 n=np.array([1+0j, alf3ndx, alndx, sio2ndx, sindx])
 t=np.array([0, 18, 50, 1.6, 0])
 thr = np.linspace(0.5,80,160)
-rfl=[Parratt(n,t,thetad, wl) for thetad in thr]
+rfl=Parratt(n, t, thr, wl)
 # Add noise
 sigmap = 0.05 # proportiional noise
 sigmac = 1e-4 # constant noise
@@ -36,7 +35,7 @@ p0 = np.array([alf3ndx.real, alf3ndx.imag, 18])
 def f(thr, n, k, t):
     ndx = np.array([1+0j, n+k*1j, alndx, sio2ndx, sindx])
     th = np.array([0, t, 50, 1.6, 0])
-    return [Parratt(ndx ,th, thetad, wl) for thetad in thr]
+    return Parratt(ndx ,th, thr, wl)
 
 def print_fit(label, popt, rms):
     print(label)
@@ -51,20 +50,12 @@ sigma = np.ones(np.size(thr))
 
 points = 100
 
-print("CONSTANT ERROR\n")
-popt, pcov = curve_fit(f, thr, refn, p0, sigma, absolute_sigma=False)
-rms = np.sqrt(np.diag(pcov))
-print_fit("Calculated uncertainty", popt, rms)
-print_fit("Exact", p0, np.zeros(3))
-
-sump = np.zeros(3)
-sumsq = np.zeros(3)
-for i in range(points):
-    refn = (rfl*(1+sigmap*np.random.randn(np.size(thr)))+
-        sigmac*np.random.randn(np.size(thr)))
+if __name__ == '__main__':
+    print("CONSTANT ERROR\n")
     popt, pcov = curve_fit(f, thr, refn, p0, sigma, absolute_sigma=False)
-    sump = sump + popt
-    sumsq = sumsq + popt**2
-mean = sump/points
-rms = np.sqrt(sumsq/points-mean**2)
-print_fit("Actual RMS", mean, rms)
\ No newline at end of file
+    rms = np.sqrt(np.diag(pcov))
+    print_fit("Calculated uncertainty", popt, rms)
+    print_fit("Exact", p0, np.zeros(3))
+
+    mc = montecarlo(f, thr, p0, sigmap, sigmac, points, sigma, pcov)
+    print_fit("Actual RMS", mc.mean, mc.rms)
@@ -7,15 +7,13 @@ Variable weights on reflectance fits
 @author: rturley
 """
 
-from refl import Parratt, Index
+from refl import Parratt, prefetch
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.optimize import curve_fit
 
-AlIndex = Index("Al")
-SiIndex = Index("Si")
-SiO2Index = Index("SiO2")
-AlF3Index = Index("AlF3")
+AlIndex, SiIndex, SiO2Index, AlF3Index = prefetch(["Al", "Si", "SiO2",
+                                                   "AlF3"])
 
 wl = 12
 alndx = AlIndex.at(wl)
@@ -26,7 +24,7 @@ alf3ndx = AlF3Index.at(wl)
 n=np.array([1+0j, alf3ndx, alndx, sio2ndx, sindx])
 t=np.array([0, 18, 50, 1.6, 0])
 thr = np.linspace(0.5,80,160)
-rfl=[Parratt(n,t,thetad, wl) for thetad in thr]
+rfl=Parratt(n, t, thr, wl)
 # Add noise
 sigmap = 0.05 # proportiional noise
 sigmac = 1e-4 # constant noise
@@ -37,7 +35,7 @@ p0 = np.array([alf3ndx.real, alf3ndx.imag, 18])
 def f(thr, n, k, t):
     ndx = np.array([1+0j, n+k*1j, alndx, sio2ndx, sindx])
     th = np.array([0, t, 50, 1.6, 0])
-    return [Parratt(ndx ,th, thetad, wl) for thetad in thr]
+    return Parratt(ndx ,th, thr, wl)
 
 def print_fit(label, popt, pcov):
     print(label)
@@ -55,7 +53,7 @@ print_fit('exact', np.array([alf3ndx.real, alf3ndx.imag, 18]),
 print_fit('unweighted fits', popt, pcov)
 ndf = np.array([1+0j, popt[0]+popt[1]*1j, alndx, sio2ndx, sindx])
 thf = np.array([0, popt[2], 50, 1.6, 0])
-rfit = [Parratt(ndf ,thf, thetad, wl) for thetad in thr]
+rfit = Parratt(ndf, thf, thr, wl)
 
 plt.close('all')
 plt.figure()
@@ -92,7 +90,7 @@ popt, pcov = curve_fit(f, thr, refn, p0, sigma, absolute_sigma=True)
 print_fit('prop weighted fits', popt, pcov)
 ndf = np.array([1+0j, popt[0]+popt[1]*1j, alndx, sio2ndx, sindx])
 thf = np.array([0, popt[2], 50, 1.6, 0])
-rfit = [Parratt(ndf ,thf, thetad, wl) for thetad in thr]
+rfit = Parratt(ndf, thf, thr, wl)
 
 plt.figure()
 plt.semilogy(thr, refn, '.', thr, rfit, '-', thr, rfl, '--')
@@ -115,7 +113,7 @@ popt, pcov = curve_fit(f, thr, refn, p0, sigma, absolute_sigma=True)
 print_fit('combined weighted fits', popt, pcov)
 ndf = np.array([1+0j, popt[0]+popt[1]*1j, alndx, sio2ndx, sindx])
 thf = np.array([0, popt[2], 50, 1.6, 0])
-rfit = [Parratt(ndf ,thf, thetad, wl) for thetad in thr]
+rfit = Parratt(ndf, thf, thr, wl)
 
 plt.figure()
 plt.semilogy(thr, refn, '.', thr, rfit, '-', thr, rfl, '--')